@@ -0,0 +1,82 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Compare twits.OAuthSigner against signing through oauth2.Request.
+
+Before timing anything, both are checked to produce the same signature for
+the same nonce and timestamp. oauth2 also signs an oauth_body_hash, which the
+check leaves out; the body of these requests is always empty.
+
+    python benchmarks/oauth.py --number 20000
+"""
+
+from twisted.python import usage
+import oauth2
+
+import urlparse
+import urllib
+import timeit
+import sys
+import os
+import re
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import twits
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['number', 'n', 10000, 'How many requests to sign per run.', int],
+        ['repeat', 'r', 3, 'How many runs to take the best of.', int],
+    ]
+
+
+consumer = oauth2.Consumer('consumer-key', 'consumer secret~')
+token = oauth2.Token('token-key', 'token secret/')
+signatureMethod = oauth2.SignatureMethod_HMAC_SHA1()
+url = 'https://api.twitter.com/1.1/statuses/lookup.json'
+parameters = {'id': '20,1234567890,987654321', 'include_entities': 'true', 'status': 'a b&c~d'}
+
+
+def oauth2Path(nonce=None, timestamp=None, bodyHash=True):
+    "What OAuthAgent.request used to do for every request."
+    extra = {}
+    if nonce is not None:
+        extra = {'oauth_nonce': nonce, 'oauth_timestamp': str(timestamp)}
+    params = dict(parameters, **extra)
+    req = oauth2.Request.from_consumer_and_token(
+        consumer, token=token, http_method='GET', http_url=url, parameters=params,
+        is_form_encoded=not bodyHash)
+    req.sign_request(signatureMethod, consumer, token)
+    header = dict((k, v.encode()) for k, v in req.to_header().iteritems())
+    parsed = urlparse.urlparse(url)
+    uri = urlparse.urlunparse(parsed._replace(query=urllib.urlencode(parameters)))
+    return header, uri
+
+
+signer = twits.OAuthSigner(consumer, token)
+
+def signerPath(nonce=None, timestamp=None):
+    return signer.sign('GET', url, parameters, nonce, timestamp)
+
+
+def signatureOf(header):
+    return urllib.unquote(re.search(r'oauth_signature="([^"]+)"', header).group(1))
+
+
+def main(argv):
+    config = Options()
+    config.parseOptions(argv)
+    old, _ = oauth2Path('0123456789abcdef', 1400000000, bodyHash=False)
+    new, _ = signerPath('0123456789abcdef', 1400000000)
+    oldSignature, newSignature = signatureOf(old['Authorization']), signatureOf(new)
+    if oldSignature != newSignature:
+        raise SystemExit('signatures differ: %r != %r' % (oldSignature, newSignature))
+
+    for name, f in [('oauth2.Request', oauth2Path), ('OAuthSigner', signerPath)]:
+        best = min(timeit.repeat(f, number=config['number'], repeat=config['repeat']))
+        print '%-16s %8.2f us/request' % (name, best / config['number'] * 1e6)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Compare twits.renderTwitText against the list-splicing renderer it replaced.
+
+The corpus is a file of tweets as JSON, one per line (e.g. saved from the
+streaming API), or a synthetic one. Tweets which both renderers can handle
+are checked to render identically before anything is timed.
+
+    python benchmarks/render.py --corpus tweets.jsonl
+"""
+
+from twisted.internet import task
+from twisted.python import usage
+
+import random
+import timeit
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import theresa
+import twits
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['corpus', 'c', None, 'File of tweets as JSON, one per line.'],
+        ['twits', 'n', 2000, 'Number of synthetic tweets to generate.', int],
+        ['repeat', 'r', 3, 'How many runs to take the best of.', int],
+        ['seed', None, 0, 'Random seed for the synthetic corpus.', int],
+    ]
+
+
+def oldExtractRealTwitText(twit):
+    "The renderer before renderTwitText, kept here for comparison."
+    if 'retweeted_status' in twit:
+        rt = twit['retweeted_status']
+        return u'RT @%s: %s' % (rt['user']['screen_name'], oldExtractRealTwitText(rt))
+    replacements = sorted(
+        (entity['indices'], entity[replacement])
+        for entityType, replacement in twits.entityReplacements
+        if entityType in twit['entities']
+        for entity in twit['entities'][entityType])
+    mutableText = list(twit['text'])
+    for (l, r), replacement in reversed(replacements):
+        mutableText[l:r] = replacement
+    text = u''.join(mutableText)
+    return twits.dumbCrapRegexp.sub(lambda m: twits.dumbCrapReplacements[m.group()], text)
+
+def oldRender(twit):
+    return theresa.escapeControls(oldExtractRealTwitText(twit))
+
+
+words = [u'the', u'a', u'twitter', u'caf\xe9', u'&amp;', u'&lt;3', u'\u2603', u'ok', u'\x07bell', u'lol']
+
+def syntheticTwit(id, rng, depth=0):
+    parts = []
+    entities = {'urls': [], 'media': []}
+    length = 0
+    for _ in xrange(rng.randrange(5, 25)):
+        if rng.random() < 0.1:
+            url = u'https://t.co/%06x' % (rng.getrandbits(24),)
+            entity = {'indices': [length, length + len(url)],
+                      'expanded_url': u'https://example.com/%d/%d' % (id, len(parts))}
+            if rng.random() < 0.2:
+                del entity['expanded_url']
+                entity['media_url_https'] = u'https://pbs.twimg.com/media/%d.jpg' % (id,)
+                entities['media'].append(entity)
+            else:
+                entities['urls'].append(entity)
+            word = url
+        else:
+            word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    twit = {
+        'id': id,
+        'id_str': str(id),
+        'text': u' '.join(parts),
+        'user': {'screen_name': u'user%d' % (id % 100,)},
+        'entities': entities,
+    }
+    if depth == 0 and rng.random() < 0.2:
+        return {'id': id + 10 ** 9, 'id_str': str(id + 10 ** 9), 'text': u'RT',
+                'user': {'screen_name': u'retwitter'}, 'entities': {},
+                'retweeted_status': syntheticTwit(id, rng, depth + 1)}
+    return twit
+
+
+def main(argv):
+    config = Options()
+    config.parseOptions(argv)
+    if config['corpus']:
+        with open(config['corpus']) as infile:
+            corpus = [json.loads(line) for line in infile if line.strip()]
+    else:
+        rng = random.Random(config['seed'])
+        # Repeat tweets the way the same tweet is shown in several channels.
+        unique = [syntheticTwit(i, rng) for i in xrange(config['twits'] // 4)]
+        corpus = [rng.choice(unique) for _ in xrange(config['twits'])]
+
+    # The old renderer only knows about 'text'; compare only on tweets
+    # without anything it would get wrong.
+    comparable = [t for t in corpus if 'extended_tweet' not in t and 'quoted_status' not in t
+                  and 'full_text' not in t]
+    mismatches = sum(1 for t in comparable if oldRender(t) != twits.renderTwitText(t))
+    print '%d tweets, %d comparable, %d rendered differently' % (
+        len(corpus), len(comparable), mismatches)
+
+    twitter = twits.Twitter(None, reactor=task.Clock())
+
+    def memoized():
+        twitter.renderCache = theresa.ExpiringCache(twitter.reactor, maxSize=4096, ttl=86400)
+        for t in corpus:
+            twitter.renderTwitText(t)
+
+    runs = [
+        ('old', lambda: [oldRender(t) for t in comparable]),
+        ('single-pass', lambda: [twits.renderTwitText(t) for t in comparable]),
+        ('memoized', memoized),
+    ]
+    for name, f in runs:
+        best = min(timeit.repeat(f, number=1, repeat=config['repeat']))
+        count = len(corpus) if name == 'memoized' else len(comparable)
+        print '%-12s %8.2f us/tweet' % (name, best / count * 1e6)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
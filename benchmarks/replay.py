@@ -0,0 +1,379 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+"""Replay IRC traffic through theresa without touching the network.
+
+Every HTTP request theresa makes goes through a ProxyAgent pointed at a local
+fake server, which stands in for arbitrary web pages, Twitter's REST and
+streaming APIs and a Tahoe-LAFS gateway. The corpus is either a file of raw
+IRC lines, as a server would send them, or generated on the fly.
+
+Run from the repository root:
+
+    python benchmarks/replay.py --messages 5000
+    python benchmarks/replay.py --corpus recorded.irc --latency 20
+"""
+
+from twisted.internet import defer, endpoints, task
+from twisted.python import failure, usage
+from twisted.test import proto_helpers
+from twisted.web import resource, server
+from twisted.web.client import ProxyAgent
+import oauth2
+
+import collections
+import urlparse
+import random
+import json
+import time
+import sys
+import os
+import gc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import theresa
+import twits
+
+
+class Options(usage.Options):
+    optFlags = [
+        ['no-shedding', None, 'Expand every link, however much is in flight.'],
+    ]
+    optParameters = [
+        ['corpus', 'c', None, 'File of raw IRC lines to replay instead of a synthetic corpus.'],
+        ['write-corpus', None, None, 'Write the synthetic corpus to this file and exit.'],
+        ['messages', 'n', 2000, 'Number of synthetic lines to generate.', int],
+        ['channels', None, 20, 'Number of synthetic channels.', int],
+        ['nicks', None, 200, 'Number of synthetic nicks.', int],
+        ['latency', 'l', 0, 'Milliseconds the fake server waits before responding.', float],
+        ['stream-rate', None, 20, 'Tweets per second sent on the fake stream.', float],
+        ['chunk', None, 100, 'Lines fed to the protocol between reactor iterations.', int],
+        ['seed', None, 0, 'Random seed for the synthetic corpus.', int],
+        ['store', None, None, 'Keep caches in this sqlite file; run twice to compare a warm start.'],
+    ]
+
+
+def fakeTwit(id):
+    text = u'twit %d &amp; a link: http://t.co/abcdef' % (id,)
+    start = text.index(u'http://')
+    return {
+        'id': id,
+        'id_str': str(id),
+        'text': text,
+        'user': {'screen_name': 'user%d' % (id % 50,)},
+        'entities': {'urls': [{
+            'indices': [start, len(text)],
+            'expanded_url': 'http://example.com/expanded/%d' % (id,),
+        }]},
+    }
+
+
+class FakeInternet(resource.Resource):
+    "Answer proxied requests as though from whichever host they were for."
+    isLeaf = True
+
+    def __init__(self, reactor, latency=0, streamRate=20):
+        resource.Resource.__init__(self)
+        self.reactor = reactor
+        self.latency = latency
+        self.streamRate = streamRate
+        self.requests = collections.Counter()
+
+    def render(self, request):
+        url = urlparse.urlparse(request.uri)
+        self.requests[url.hostname] += 1
+        if url.hostname == 'userstream.twitter.com':
+            return self.renderStream(request)
+        if url.hostname == 'api.twitter.com':
+            render = self.renderTwitter
+        elif url.hostname == 'tahoe.invalid':
+            render = self.renderTahoe
+        else:
+            render = self.renderPage
+        if not self.latency:
+            return render(request, url)
+
+        def _respond():
+            if request.finished or request._disconnected:
+                return
+            request.write(render(request, url))
+            request.finish()
+        self.reactor.callLater(self.latency, _respond)
+        return server.NOT_DONE_YET
+
+    def renderPage(self, request, url):
+        path = url.path
+        if path.startswith('/redirect/'):
+            request.setResponseCode(301)
+            request.setHeader('location', url._replace(path=path[len('/redirect'):]).geturl())
+            return ''
+        if path.endswith('.png'):
+            request.setHeader('content-type', 'image/png')
+            return '\x89PNG\r\n\x1a\n' + '\0' * 16384
+        if path.startswith('/missing/'):
+            request.setResponseCode(404)
+            return ''
+        request.setHeader('content-type', 'text/html; charset=utf-8')
+        junk = '<meta name="x" content="%s">' % ('y' * 80,)
+        return (
+            '<!DOCTYPE html><html><head>%s<title>Page at %s</title></head>'
+            '<body>%s</body></html>' % (junk * 20, path, 'z' * 8192))
+
+    def renderTwitter(self, request, url):
+        request.setHeader('content-type', 'application/json')
+        params = urlparse.parse_qs(url.query)
+        if url.path.endswith('/statuses/lookup.json'):
+            ids = params['id'][0].split(',')
+            return json.dumps([fakeTwit(int(id)) for id in ids])
+        if url.path.endswith('/statuses/show.json'):
+            return json.dumps(fakeTwit(int(params['id'][0])))
+        if url.path.endswith('/statuses/user_timeline.json'):
+            return json.dumps([fakeTwit(1)])
+        request.setResponseCode(404)
+        return '{}'
+
+    def renderTahoe(self, request, url):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps({'results': {
+            'healthy': True,
+            'recoverable': True,
+            'count-shares-needed': 3,
+            'count-shares-expected': 10,
+            'count-shares-good': 10,
+            'count-good-share-hosts': 7,
+        }})
+
+    def renderStream(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.write(json.dumps({'friends': []}) + '\r\n')
+        ids = iter(xrange(10 ** 6, 10 ** 7))
+
+        def _send():
+            twit = fakeTwit(next(ids))
+            twit['timestamp_ms'] = str(int(self.reactor.seconds() * 1000))
+            request.write(json.dumps(twit) + '\r\n')
+        loop = task.LoopingCall(_send)
+        loop.clock = self.reactor
+        loop.start(1. / self.streamRate)
+        request.notifyFinish().addBoth(lambda ign: loop.stop())
+        return server.NOT_DONE_YET
+
+
+def syntheticCorpus(messages, channels, nicks, rng):
+    channelNames = ['#chan%d' % (i,) for i in xrange(channels)]
+    nickNames = ['nick%d' % (i,) for i in xrange(nicks)]
+    lines = []
+    for channel in channelNames:
+        for nick in rng.sample(nickNames, min(len(nickNames), 30)):
+            lines.append(':%s!u@h JOIN %s' % (nick, channel))
+    capabilities = ['URI:CHK:%032x:%032x:3:10:1024' % (rng.getrandbits(128), rng.getrandbits(128))
+                    for _ in xrange(10)]
+    renamed = 0
+    for i in xrange(messages):
+        nick = rng.choice(nickNames)
+        channel = rng.choice(channelNames)
+        prefix = '%s!u@h' % (nick,)
+        roll = rng.random()
+        if roll < 0.6:
+            text = 'just chatting about thing number %d, nothing to see' % (i,)
+        elif roll < 0.75:
+            # Repeat some URLs so that caching gets exercised.
+            text = 'look at http://site%d.example/page/%d' % (rng.randrange(50), rng.randrange(20))
+        elif roll < 0.78:
+            text = 'redirected: http://site%d.example/redirect/page/%d' % (rng.randrange(50), i)
+        elif roll < 0.80:
+            text = 'an image http://img.example/%d.png and http://gone.example/missing/%d' % (i, i)
+        elif roll < 0.85:
+            text = 'twit https://twitter.com/user/status/%d' % (rng.randrange(10 ** 5),)
+        elif roll < 0.87:
+            # The same few files get pasted over and over.
+            text = 'a file %s' % (rng.choice(capabilities),)
+        elif roll < 0.89:
+            text = ',queue'
+        elif roll < 0.93:
+            lines.append(':%s JOIN %s' % (prefix, channel))
+            continue
+        elif roll < 0.96:
+            lines.append(':%s PART %s :bye' % (prefix, channel))
+            continue
+        elif roll < 0.98:
+            lines.append(':%s QUIT :gone' % (prefix,))
+            continue
+        else:
+            renamed += 1
+            newNick = 'renamed%d' % (renamed,)
+            nickNames[nickNames.index(nick)] = newNick
+            lines.append(':%s NICK :%s' % (prefix, newNick))
+            continue
+        lines.append(':%s PRIVMSG %s :%s' % (prefix, channel, text))
+    return lines
+
+
+class Timings(object):
+    "Collect per-stage latencies."
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.samples = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, stage, elapsed):
+        self.samples[stage].append(elapsed)
+
+    def wrap(self, stage, f):
+        "Wrap a `Deferred`-returning callable to record how long it takes."
+        def wrapper(*a, **kw):
+            start = self.clock()
+            d = f(*a, **kw)
+            if d is None:
+                return d
+
+            def _done(r):
+                self.record(stage, self.clock() - start)
+                if isinstance(r, failure.Failure):
+                    self.errors[stage] += 1
+                return r
+            return d.addBoth(_done)
+        return wrapper
+
+    def report(self, out):
+        out.write('%-12s %8s %8s %10s %10s %10s %10s\n' % (
+            'stage', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for stage, samples in sorted(self.samples.iteritems()):
+            samples.sort()
+            pct = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+            if not samples:
+                continue
+            out.write('%-12s %8d %8d %10.2f %10.2f %10.2f %10.2f\n' % (
+                stage, len(samples), self.errors[stage], pct(.5), pct(.9), pct(.99), samples[-1] * 1000))
+
+
+class BenchProtocol(theresa.TheresaProtocol):
+    nickname = 'theresa'
+    outputRate = 1e9
+    outputBurst = 1e9
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    config = Options()
+    config.parseOptions(argv)
+    rng = random.Random(config['seed'])
+
+    if config['corpus']:
+        with open(config['corpus']) as infile:
+            lines = [line.rstrip('\r\n') for line in infile if line.strip()]
+    else:
+        lines = syntheticCorpus(config['messages'], config['channels'], config['nicks'], rng)
+    if config['write-corpus']:
+        with open(config['write-corpus'], 'w') as outfile:
+            outfile.writelines(line + '\n' for line in lines)
+        return
+
+    fake = FakeInternet(reactor, config['latency'] / 1000., config['stream-rate'])
+    port = yield endpoints.TCP4ServerEndpoint(reactor, 0, interface='127.0.0.1').listen(server.Site(fake))
+    pool = theresa.ConnectionPool(reactor)
+    pool.maxPersistentPerHost = 16
+    agent = ProxyAgent(
+        endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1', port.getHost().port), reactor, pool=pool)
+    store = None
+    if config['store']:
+        store = theresa.PersistentStore(reactor, config['store'])
+        store.startService()
+    twitter = twits.Twitter(
+        twits.OAuthAgent(agent, oauth2.Consumer('key', 'secret'), oauth2.Token('key', 'secret')),
+        reactor=reactor, persistentStore=store)
+    shedder = None
+    if config['no-shedding']:
+        unlimited = (float('inf'),) * 3
+        shedder = theresa.LinkShedder(
+            reactor, inFlightLevels=unlimited, latencyLevels=unlimited, perChannel=float('inf'),
+            metrics=twitter.metrics)
+    factory = theresa.TheresaFactory(agent, twitter, tahoe='http://tahoe.invalid/uri/', reactor=reactor,
+                                     persistentStore=store, linkShedder=shedder)
+    factory.protocol = BenchProtocol
+
+    timings = Timings()
+    channels = sorted(set(line.split()[2] for line in lines if ' PRIVMSG #' in line))
+    proto = factory.buildProtocol(None)
+    proto.channels = channels
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    proto.dataReceived(':server 001 theresa :Welcome\r\n')
+    proto.dataReceived(':server 005 theresa PREFIX=(ov)@+ CASEMAPPING=rfc1459 :are supported\r\n')
+    for name, stage in [('fetchURLInfo', 'urlInfo'), ('_checkTahoe', 'tahoe')]:
+        setattr(proto, name, timings.wrap(stage, getattr(proto, name)))
+    for host, stage in [('twitter.com', 'twitter'), ('gyazo.com', 'gyazo')]:
+        resolver = factory.linkResolvers.resolverFor(host)
+        resolver.fetch = timings.wrap(stage, resolver.fetch)
+    pending = set()
+    scanMessage = timings.wrap('scan', proto.scanMessage)
+
+    def trackedScan(channel, message):
+        d = scanMessage(channel, message)
+        if d is not None:
+            pending.add(d)
+            d.addBoth(lambda r: pending.discard(d))
+        return d
+    proto.scanMessage = trackedScan
+
+    streamLag = []
+    streamDelegate = proto.twitDelegate(channels[:5])
+
+    def delegate(data):
+        if 'text' not in data:
+            return
+        streamLag.append(reactor.seconds() - int(data['timestamp_ms']) / 1000.)
+        streamDelegate(data)
+    streamer = twits.StreamPreserver(twitter, 'user.json', messageTypes=['tweet'])
+    streamer.addDelegate(delegate)
+    streamer.startService()
+
+    gc.collect()
+    objectsBefore = len(gc.get_objects())
+    started = time.time()
+    dispatchTime = [0.]
+
+    def feed():
+        for i, line in enumerate(lines):
+            start = time.time()
+            proto.dataReceived(line + '\r\n')
+            elapsed = time.time() - start
+            dispatchTime[0] += elapsed
+            timings.record('dispatch', elapsed)
+            if i % config['chunk'] == 0:
+                transport.clear()
+                yield None
+    yield task.cooperate(feed()).whenDone()
+    fed = time.time()
+    while pending:
+        yield defer.DeferredList(list(pending))
+    finished = time.time()
+
+    gc.collect()
+    objectsAfter = len(gc.get_objects())
+    timings.samples['stream lag'] = streamLag
+    yield streamer.stopService()
+    if store is not None:
+        yield store.stopService()
+    yield pool.closeCachedConnections()
+    yield port.stopListening()
+
+    out = sys.stdout
+    out.write('%d lines replayed in %.3fs (%.0f lines/s fed, %.0f lines/s until all replies)\n' % (
+        len(lines), finished - started, len(lines) / (fed - started), len(lines) / (finished - started)))
+    out.write('dispatch alone: %.0f lines/s\n' % (len(lines) / dispatchTime[0],))
+    out.write('output: %r\n' % (proto.outputScheduler.stats(),))
+    out.write('fake server requests by host: %d total, %d distinct hosts\n' % (
+        sum(fake.requests.values()), len(fake.requests)))
+    out.write('connection pool: %s\n' % (pool.stats(),))
+    out.write('tahoe checks: %d sent to the gateway; cache %s\n' % (
+        fake.requests['tahoe.invalid'], dict(factory.tahoeCheckCache.counts)))
+    for line in factory.metrics.summaryLines():
+        out.write('metrics: %s\n' % (line,))
+    out.write('live objects: %d before, %d after (%+d)\n' % (
+        objectsBefore, objectsAfter, objectsAfter - objectsBefore))
+    timings.report(out)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
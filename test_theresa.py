@@ -0,0 +1,180 @@
+# Copyright (c) Aaron Gallagher <_@habnab.it>
+# See COPYING for details.
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+
+import json
+
+import theresa
+import twits
+
+
+class FakeResponse(object):
+    def __init__(self, body, code=200):
+        self.code = code
+        self.body = body
+        self.length = len(body)
+
+    def deliverBody(self, protocol):
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+class FakeGateway(object):
+    "An Agent standing in for Tahoe-LAFS gateways; requests wait for `respond`."
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+    def respond(self, healthy=True, index=0):
+        method, url, d = self.requests[index]
+        d.callback(FakeResponse(json.dumps({'results': {
+            'healthy': healthy,
+            'recoverable': True,
+            'count-shares-needed': 3,
+            'count-shares-expected': 10,
+            'count-shares-good': 10 if healthy else 5,
+            'count-good-share-hosts': 10 if healthy else 5,
+        }})))
+
+
+class Fetcher(object):
+    "Fetches whose results are given later, with `succeed` and `fail`."
+    def __init__(self):
+        self.pending = []
+        self.calls = 0
+
+    def __call__(self, key):
+        self.calls += 1
+        d = defer.Deferred()
+        self.pending.append((key, d))
+        return d
+
+    def succeed(self, value, index=0):
+        self.pending.pop(index)[1].callback(value)
+
+    def fail(self, exception, index=0):
+        self.pending.pop(index)[1].errback(exception)
+
+
+class RevalidatingCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = theresa.RevalidatingCache(
+            self.clock, ttl=10, staleTTL=100, negativeTTL=5, concurrency=2)
+        self.fetch = Fetcher()
+
+    def lookup(self, key='key'):
+        results = []
+        self.cache.lookup(key, self.fetch, key).addBoth(results.append)
+        return results
+
+    def test_freshHit(self):
+        first = self.lookup()
+        self.fetch.succeed('value')
+        self.clock.advance(9)
+        self.assertEqual(self.lookup(), ['value'])
+        self.assertEqual(first, ['value'])
+        self.assertEqual(self.fetch.calls, 1)
+        self.assertEqual(self.cache.counts['fresh'], 1)
+
+    def test_staleHitRefreshesOnce(self):
+        self.lookup()
+        self.fetch.succeed('old')
+        self.clock.advance(11)
+        self.assertEqual(self.lookup(), ['old'])
+        self.assertEqual(self.lookup(), ['old'])
+        self.assertEqual(self.fetch.calls, 2)
+        self.assertEqual(self.cache.counts['refresh'], 1)
+        self.fetch.succeed('new')
+        self.assertEqual(self.lookup(), ['new'])
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_failedRefreshKeepsStale(self):
+        self.lookup()
+        self.fetch.succeed('old')
+        self.clock.advance(11)
+        self.lookup()
+        self.fetch.fail(ValueError())
+        self.assertEqual(self.lookup(), ['old'])
+        self.assertEqual(self.fetch.calls, 2)
+        self.assertEqual(self.cache.counts['refreshFailed'], 1)
+        # The failed refresh is retried after negativeTTL.
+        self.clock.advance(6)
+        self.assertEqual(self.lookup(), ['old'])
+        self.assertEqual(self.fetch.calls, 3)
+
+    def test_negativeTTL(self):
+        first = self.lookup()
+        self.fetch.fail(ValueError())
+        first[0].trap(ValueError)
+        self.clock.advance(4)
+        self.lookup()[0].trap(ValueError)
+        self.assertEqual(self.fetch.calls, 1)
+        self.clock.advance(2)
+        self.lookup()
+        self.assertEqual(self.fetch.calls, 2)
+
+    def test_concurrencyCap(self):
+        for key in 'abc':
+            self.lookup(key)
+        self.assertEqual([key for key, d in self.fetch.pending], ['a', 'b'])
+        self.fetch.succeed('a')
+        self.assertEqual([key for key, d in self.fetch.pending], ['b', 'c'])
+
+
+class CheckTahoeTests(unittest.TestCase):
+    uri = 'URI:CHK:aaaa:bbbb:3:10:1024'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.gateway = FakeGateway()
+        self.cache = theresa.RevalidatingCache(self.clock, ttl=10, staleTTL=100)
+
+    def protocol(self, tahoe='http://gateway.invalid/uri/'):
+        factory = theresa.TheresaFactory(
+            self.gateway, twits.Twitter(None, reactor=self.clock), tahoe=tahoe,
+            reactor=self.clock, tahoeCheckCache=self.cache)
+        return factory.buildProtocol(None)
+
+    def check(self, protocol):
+        results = []
+        protocol._checkTahoe(self.uri).addBoth(results.append)
+        return results
+
+    def test_check(self):
+        results = self.check(self.protocol())
+        [(method, url, d)] = self.gateway.requests
+        self.assertEqual(method, 'POST')
+        self.assertEqual(
+            url, 'http://gateway.invalid/uri/URI%3ACHK%3Aaaaa%3Abbbb%3A3%3A10%3A1024?t=check&output=json')
+        self.gateway.respond()
+        self.assertIn('healthy; recoverable; 3-of-10 encoded', results[0])
+
+    def test_cachedAndRevalidated(self):
+        protocol = self.protocol()
+        self.check(protocol)
+        self.gateway.respond(healthy=True)
+        self.assertIn('healthy', self.check(protocol)[0])
+        self.assertEqual(len(self.gateway.requests), 1)
+        self.clock.advance(11)
+        self.assertNotIn('unhealthy', self.check(protocol)[0])
+        self.assertEqual(len(self.gateway.requests), 2)
+        self.gateway.respond(healthy=False, index=1)
+        self.assertIn('unhealthy', self.check(protocol)[0])
+
+    def test_gatewaysDontShareResults(self):
+        self.check(self.protocol('http://one.invalid/uri/'))
+        self.gateway.respond()
+        self.check(self.protocol('http://two.invalid/uri/'))
+        self.assertEqual(len(self.gateway.requests), 2)
+        self.assertTrue(self.gateway.requests[1][1].startswith('http://two.invalid/'))
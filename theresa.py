@@ -2,25 +2,37 @@
 # See COPYING for details.
 
 from twisted.internet.error import ConnectionDone, ConnectionLost
-from twisted.internet import protocol, defer, endpoints
-from twisted.python import log
-from twisted.web.client import ResponseDone, ResponseFailed
+from twisted.internet import protocol, defer, endpoints, task, threads
+from twisted.application.service import MultiService, Service
+from twisted.enterprise import adbapi
+from twisted.python.threadpool import ThreadPool
+from twisted.python import failure, log
+from twisted.internet.interfaces import IHostnameResolver, IHostResolution, IResolutionReceiver
+from twisted.web.client import HTTPConnectionPool, ResponseDone, ResponseFailed
+from twisted.web.iweb import UNKNOWN_LENGTH
 from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web import resource, server
 from twisted.words.protocols import irc
 
-from lxml import html
+from zope.interface import implementer
+from lxml import etree
 import magic
 
 import collections
 import mimetypes
+import cPickle
+import bisect
 import traceback
 import operator
 import urlparse
 import urllib
 import struct
 import socket
+import string
 import shlex
 import json
+import zlib
 import cgi
 import re
 import os
@@ -44,89 +56,1522 @@ def c(text, *colors):
 twitter_regexp = re.compile(r'twitter\.com/(?:#!/)?[^/]+/status(?:es)?/(\d+)')
 gyazo_regexp = re.compile('https?://gyazo\.com/[0-9a-f]+')
 
-class StringReceiver(protocol.Protocol):
+class ResponseTooLarge(Exception):
+    pass
+
+def _endedCleanly(reason):
+    return ((reason.check(ResponseFailed) and any(exn.check(ConnectionDone, ConnectionLost)
+                                                  for exn in reason.value.reasons))
+            or reason.check(ResponseDone, PotentialDataLoss))
+
+class BodyReceiver(protocol.Protocol):
+    """A protocol for reading as much of a response body as is needed.
+
+    Subclasses get each chunk passed to `bodyReceived` and call `_enough` with
+    the result once they don't need any more. If the rest of the body is no
+    more than `drainLimit` bytes, it's read and thrown away so the connection
+    can go back to the pool; otherwise, the connection is closed. `receive`
+    sets `length` from the response. If the body ends first, the `Deferred`
+    fires with what `_result` returns.
+    """
+    drainLimit = 65536
+    length = UNKNOWN_LENGTH
+
+    def __init__(self):
+        self.deferred = defer.Deferred(self._cancel)
+        self._received = 0
+        self._finished = False
+
+    def _cancel(self, ign):
+        self._finished = True
+        self.transport.stopProducing()
+
+    def _enough(self, result):
+        self._finished = True
+        if self.length is UNKNOWN_LENGTH or self.length - self._received > self.drainLimit:
+            self.transport.stopProducing()
+        self.deferred.callback(result)
+
+    def _fail(self, exception):
+        "Give up on the body, closing the connection."
+        self._finished = True
+        self.transport.stopProducing()
+        self.deferred.errback(exception)
+
+    def dataReceived(self, data):
+        if self._finished:
+            return
+        self._received += len(data)
+        self.bodyReceived(data)
+
+    def bodyReceived(self, data):
+        raise NotImplementedError()
+
+    def _result(self):
+        raise NotImplementedError()
+
+    def connectionLost(self, reason):
+        if self._finished:
+            return
+        self._finished = True
+        if _endedCleanly(reason):
+            try:
+                result = self._result()
+            except Exception:
+                self.deferred.errback()
+            else:
+                self.deferred.callback(result)
+        else:
+            self.deferred.errback(reason)
+
+class StringReceiver(BodyReceiver):
     def __init__(self, byteLimit=None):
+        BodyReceiver.__init__(self)
         self.bytesRemaining = byteLimit
-        self.deferred = defer.Deferred()
         self._buffer = []
 
-    def dataReceived(self, data):
+    def bodyReceived(self, data):
         data = data[:self.bytesRemaining]
         self._buffer.append(data)
         if self.bytesRemaining is not None:
             self.bytesRemaining -= len(data)
             if not self.bytesRemaining:
-                self.transport.stopProducing()
+                self._enough(self._result())
 
-    def connectionLost(self, reason):
-        if ((reason.check(ResponseFailed) and any(exn.check(ConnectionDone, ConnectionLost)
-                                                  for exn in reason.value.reasons))
-                or reason.check(ResponseDone, PotentialDataLoss)):
-            self.deferred.callback(''.join(self._buffer))
-        else:
-            self.deferred.errback(reason)
+    def _result(self):
+        return ''.join(self._buffer)
+
+class JSONReceiver(BodyReceiver):
+    """Read a JSON body of at most `byteLimit` bytes and decode it with `loads`.
+
+    A body which is, or says it will be, larger than that fails with
+    `ResponseTooLarge` as soon as that's known, and its connection is closed.
+    """
+    def __init__(self, byteLimit=1048576, loads=json.loads):
+        BodyReceiver.__init__(self)
+        self.byteLimit = byteLimit
+        self.loads = loads
+        self._buffer = []
+
+    def _tooLarge(self):
+        self._fail(ResponseTooLarge('response body is over %d bytes' % (self.byteLimit,)))
+
+    def connectionMade(self):
+        if self.length is not UNKNOWN_LENGTH and self.length > self.byteLimit:
+            self._tooLarge()
+
+    def bodyReceived(self, data):
+        if self._received > self.byteLimit:
+            self._buffer = []
+            self._tooLarge()
+            return
+        self._buffer.append(data)
+
+    def _result(self):
+        body = ''.join(self._buffer)
+        self._buffer = []
+        return self.loads(body)
+
+class _Discarder(BodyReceiver):
+    def connectionMade(self):
+        self._enough(None)
+
+def discard(response):
+    """Throw away the body of a response which isn't going to be read.
+
+    Small bodies are read, so the connection can be reused; large ones, or
+    ones of unknown length, get their connection closed.
+    """
+    return receive(response, _Discarder())
+
+class _TitleTarget(object):
+    "An lxml parser target which only collects the first <title>."
+    def __init__(self):
+        self.inTitle = False
+        self.done = False
+        self._chunks = []
+
+    def start(self, tag, attrib):
+        if tag == 'title' and not self.done:
+            self.inTitle = True
+
+    def end(self, tag):
+        if tag == 'title' and self.inTitle:
+            self.inTitle = False
+            self.done = True
+
+    def data(self, data):
+        if self.inTitle:
+            self._chunks.append(data)
+
+    def close(self):
+        if not self._chunks:
+            return None
+        return u''.join(self._chunks)
+
+titleEndRegex = re.compile('</title', re.I)
+
+def parseTitle(body, encoding=None):
+    "Find the first <title> in some HTML, or return None if there isn't one."
+    target = _TitleTarget()
+    try:
+        parser = etree.HTMLParser(target=target, encoding=encoding)
+    except LookupError:
+        parser = etree.HTMLParser(target=target)
+    try:
+        parser.feed(body)
+        return parser.close()
+    except etree.LxmlError:
+        return target.close()
+
+class TitleReceiver(BodyReceiver):
+    """Read HTML until the end of its <title>.
+
+    The transfer is stopped as soon as the end of the title has been seen or
+    `byteLimit` bytes have been read, whichever comes first. The `Deferred`
+    fires with what was read, to be parsed with `parseTitle`; only a cheap
+    search for '</title' happens while receiving.
+    """
+    def __init__(self, byteLimit=65536):
+        BodyReceiver.__init__(self)
+        self.bytesRemaining = byteLimit
+        self._buffer = []
+        self._tail = ''
+
+    def bodyReceived(self, data):
+        data = data[:self.bytesRemaining]
+        self.bytesRemaining -= len(data)
+        self._buffer.append(data)
+        # The end tag might be split between two chunks.
+        searched, self._tail = self._tail + data, data[-7:]
+        if titleEndRegex.search(searched) or self.bytesRemaining <= 0:
+            self._enough(self._result())
+
+    def _result(self):
+        return ''.join(self._buffer)
 
 def receive(response, receiver):
+    receiver.length = response.length
     response.deliverBody(receiver)
     return receiver.deferred
 
+class ConnectionPool(HTTPConnectionPool):
+    """An `HTTPConnectionPool` which counts how often connections are reused.
+
+    `perHost` maps hostnames to how many idle connections to keep to them,
+    instead of `maxPersistentPerHost`. Connections which are already closing
+    when their response finishes, because a body was cut short, aren't pooled.
+    """
+    def __init__(self, reactor, persistent=True, perHost=None, metrics=None):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.perHost = perHost or {}
+        self.metrics = metrics
+        self.counts = collections.Counter()
+        if metrics is not None:
+            metrics.gauges['connectionPool'] = self.stats
+
+    def _count(self, name):
+        self.counts[name] += 1
+        if self.metrics is not None:
+            self.metrics.count('pool.' + name)
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key, [])
+        for connection in list(connections):
+            if connection.transport.disconnecting:
+                connections.remove(connection)
+                connection.transport.loseConnection()
+                self._timeouts.pop(connection).cancel()
+        # The base class skips over connections which aren't quiescent.
+        hit = any(connection.state == 'QUIESCENT' for connection in connections)
+        self._count('hit' if hit else 'miss')
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _putConnection(self, key, connection):
+        if connection.transport.disconnecting:
+            self._count('closing')
+            return
+        limit = self.perHost.get(key[1], self.maxPersistentPerHost)
+        connections = self._connections.setdefault(key, [])
+        while connections and len(connections) >= limit:
+            dropped = connections.pop(0)
+            dropped.transport.loseConnection()
+            self._timeouts.pop(dropped).cancel()
+            self._count('evicted')
+        if limit < 1:
+            connection.transport.loseConnection()
+            return
+        # The base class only evicts once there are exactly
+        # maxPersistentPerHost connections, which there aren't now.
+        connections.append(connection)
+        self._timeouts[connection] = self._reactor.callLater(
+            self.cachedConnectionTimeout, self._removeConnection, key, connection)
+
+    def stats(self):
+        return dict(
+            self.counts,
+            idle=sum(len(connections) for connections in self._connections.itervalues()))
+
+@implementer(IHostResolution)
+class _CachedResolution(object):
+    def __init__(self, name):
+        self.name = name
+
+    def cancel(self):
+        pass
+
+@implementer(IResolutionReceiver)
+class _CollectingReceiver(object):
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.addresses = []
+
+    def resolutionBegan(self, resolution):
+        pass
+
+    def addressResolved(self, address):
+        self.addresses.append(address)
+
+    def resolutionComplete(self):
+        self.deferred.callback(self.addresses)
+
+@implementer(IHostnameResolver)
+class CachingNameResolver(object):
+    """Remember what hostnames resolved to, for `ttl` seconds.
+
+    getaddrinfo doesn't say how long its answers are good for, so every name
+    is kept for the same time; names which didn't resolve are kept for
+    `negativeTTL` seconds. Install one with `reactor.installNameResolver`.
+    """
+    def __init__(self, resolver, reactor, ttl=300, negativeTTL=30, maxSize=1024, metrics=None):
+        self.resolver = resolver
+        self.metrics = metrics
+        self._cache = ExpiringCache(
+            reactor, maxSize, ttl, negativeTTL, isNegative=lambda addresses: not addresses)
+
+    def _resolve(self, hostName, portNumber, addressTypes, transportSemantics):
+        d = defer.Deferred()
+        self.resolver.resolveHostName(
+            _CollectingReceiver(d), hostName, portNumber, addressTypes, transportSemantics)
+        return d
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0, addressTypes=None,
+                        transportSemantics='TCP'):
+        key = hostName, portNumber, addressTypes and tuple(addressTypes), transportSemantics
+        if self.metrics is not None:
+            try:
+                self._cache.get(key)
+            except KeyError:
+                self.metrics.count('dns.miss')
+            else:
+                self.metrics.count('dns.hit')
+        resolution = _CachedResolution(hostName)
+        resolutionReceiver.resolutionBegan(resolution)
+        d = self._cache.lookup(
+            key, self._resolve, hostName, portNumber, addressTypes, transportSemantics)
+
+        @d.addCallback
+        def _resolved(addresses):
+            for address in addresses:
+                resolutionReceiver.addressResolved(address)
+
+        d.addErrback(log.err, 'error resolving %r' % (hostName,))
+        # Complete even after an error, or the endpoint waits for its own timeout.
+        d.addCallback(lambda ign: resolutionReceiver.resolutionComplete())
+        return resolution
+
+class Saturated(Exception):
+    "Too much is already going on locally; this says nothing about what was asked for."
+
+class WorkerPool(object):
+    """Run CPU-bound functions, like parsing, on a bounded pool of threads.
+
+    Once `threads` calls are running and `maxQueued` more are waiting, further
+    calls fail right away with `Saturated`. A call which hasn't finished after
+    `timeout` seconds fails with `defer.TimeoutError`, or `Saturated` if it
+    never got a thread, but its thread can't be interrupted, so it keeps
+    counting against the limits until it's done.
+    """
+    def __init__(self, reactor, threads=2, maxQueued=32, timeout=5, metrics=None, name='theresa'):
+        self.reactor = reactor
+        self.threads = threads
+        self.maxQueued = maxQueued
+        self.timeout = timeout
+        self.metrics = metrics
+        self.threadpool = ThreadPool(1, threads, name=name)
+        self.pending = 0
+        self.counts = collections.Counter()
+
+    def _start(self):
+        self.threadpool.start()
+        self.reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+
+    def _finished(self, name, queuedAt, startedAt, finishedAt):
+        self.pending -= 1
+        self.counts['completed'] += 1
+        if self.metrics is not None:
+            self.metrics.observe('pool.wait', startedAt - queuedAt)
+            self.metrics.observe('parse.' + name, finishedAt - startedAt)
+
+    def _timedOut(self, f, started):
+        f.trap(defer.TimeoutError)
+        if not started:
+            self.counts['saturated'] += 1
+            raise Saturated('no thread free within %ds' % (self.timeout,))
+        self.counts['timedOut'] += 1
+        return f
+
+    def run(self, name, f, *args, **kwargs):
+        "Call `f` with the remaining arguments on a thread; `name` is what to time it as."
+        if self.pending >= self.threads + self.maxQueued:
+            self.counts['saturated'] += 1
+            return defer.fail(Saturated('%d calls are already pending' % (self.pending,)))
+        if not self.threadpool.started:
+            self._start()
+        self.pending += 1
+        queuedAt = self.reactor.seconds()
+        started = []
+
+        def _work():
+            started.append(True)
+            startedAt = self.reactor.seconds()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.reactor.callFromThread(
+                    self._finished, name, queuedAt, startedAt, self.reactor.seconds())
+
+        d = threads.deferToThreadPool(self.reactor, self.threadpool, _work)
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self.reactor)
+            d.addErrback(self._timedOut, started)
+        return d
+
+    def stats(self):
+        return dict(
+            self.counts,
+            running=min(self.pending, self.threads),
+            queued=max(0, self.pending - self.threads))
+
+def _runIn(pool, name, f, *args):
+    if pool is None:
+        return defer.maybeDeferred(f, *args)
+    return pool.run(name, f, *args)
+
+def formatDuration(seconds):
+    if seconds < 1:
+        return '%.0fms' % (seconds * 1000,)
+    return '%.1fs' % (seconds,)
+
+class Histogram(object):
+    """Counts durations into buckets which double in size.
+
+    The smallest bucket is everything up to a millisecond, so quantiles are
+    only accurate to within a factor of two, but observing is cheap.
+    """
+    bounds = tuple(0.001 * 2 ** i for i in xrange(18))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        "The upper bound of the bucket the `q` quantile falls in."
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+class Metrics(object):
+    """Counters and latency histograms for each stage of handling a message.
+
+    Names are dotted, e.g. 'url.fetch'. Timing a `Deferred` records how long
+    it took under its name and counts failures under the name plus '.errors'.
+    Gauges are callables returning something JSON-serializable, which are
+    only called when a snapshot is taken.
+    """
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.started = reactor.seconds()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    def timed(self, name, d):
+        "Time `d` from now until it fires, and return it."
+        started = self.reactor.seconds()
+
+        def _done(result):
+            self.observe(name, self.reactor.seconds() - started)
+            if isinstance(result, failure.Failure):
+                self.count(name + '.errors')
+            return result
+
+        return d.addBoth(_done)
+
+    def timeCall(self, name, f, *args, **kwargs):
+        "Call `f` with the remaining arguments and time the result."
+        return self.timed(name, defer.maybeDeferred(f, *args, **kwargs))
+
+    def snapshot(self):
+        return {
+            'uptime': self.reactor.seconds() - self.started,
+            'counters': dict(self.counters),
+            'histograms': dict(
+                (name, histogram.summary()) for name, histogram in self.histograms.iteritems()),
+            'gauges': dict((name, gauge()) for name, gauge in self.gauges.iteritems()),
+        }
+
+    def summaryLines(self, prefix=''):
+        "Describe the histograms and counters whose names start with `prefix`."
+        lines = []
+        for name in sorted(self.histograms):
+            if not name.startswith(prefix):
+                continue
+            summary = self.histograms[name].summary()
+            lines.append('%s: %d, %d failed; p50 %s, p90 %s, p99 %s, max %s' % (
+                name, summary['count'], self.counters.get(name + '.errors', 0),
+                formatDuration(summary['p50']), formatDuration(summary['p90']),
+                formatDuration(summary['p99']), formatDuration(summary['max'])))
+        counters = sorted(
+            '%s=%d' % (name, value) for name, value in self.counters.iteritems()
+            if name.startswith(prefix) and name.rpartition('.errors')[0] not in self.histograms)
+        if counters:
+            lines.append('counters: ' + ', '.join(counters))
+        return lines
+
+class StatsResource(resource.Resource):
+    "Serves a snapshot of some `Metrics`, or anything else with a `snapshot` method, as JSON."
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(self.metrics.snapshot(), sort_keys=True, indent=2, default=repr)
+
+def statsService(metrics, description='tcp:8080:interface=127.0.0.1'):
+    "A service serving `metrics` over HTTP on the strports endpoint `description`."
+    from twisted.application import strports
+    return strports.service(description, server.Site(StatsResource(metrics)))
+
+def _storedKey(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return buffer(str(key))
+
+class PersistentStore(Service):
+    """A sqlite file which caches keep their entries in across restarts.
+
+    Nothing is read until a cache misses. Writes are collected and flushed
+    every `flushInterval` seconds in one transaction on adbapi's thread.
+    Entries are dropped once they expire or were written more than `maxAge`
+    seconds ago, and the oldest are dropped past `maxEntries`; this pruning
+    happens every `pruneInterval` seconds.
+    """
+    def __init__(self, reactor, path, flushInterval=5, maxAge=7 * 86400, maxEntries=100000,
+                 pruneInterval=3600):
+        self.reactor = reactor
+        self.path = path
+        self.flushInterval = flushInterval
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.pruneInterval = pruneInterval
+        self.pool = adbapi.ConnectionPool(
+            'sqlite3', path, check_same_thread=False, cp_min=1, cp_max=1, cp_reactor=reactor)
+        self._pending = {}
+        self._flushingEntries = {}
+        self._flushing = None
+        self._flushLoop = task.LoopingCall(self.flush)
+        self._flushLoop.clock = reactor
+        self._pruneLoop = task.LoopingCall(self.prune)
+        self._pruneLoop.clock = reactor
+        # There's only one connection, so everything else waits for this.
+        self.pool.runInteraction(self._createTables).addErrback(
+            log.err, 'error creating persistent cache tables in %r' % (path,))
+
+    def _createTables(self, txn):
+        txn.execute(
+            'CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key BLOB NOT NULL, '
+            'value BLOB NOT NULL, expires REAL, written REAL NOT NULL, '
+            'PRIMARY KEY (namespace, key))')
+        txn.execute('CREATE INDEX IF NOT EXISTS entries_written ON entries (written)')
+
+    def namespace(self, name):
+        "The part of the store for one cache."
+        return PersistentNamespace(self, name)
+
+    def _get(self, txn, namespace, key, now):
+        txn.execute(
+            'SELECT expires, value FROM entries WHERE namespace = ? AND key = ? '
+            'AND (expires IS NULL OR expires > ?) AND written > ?',
+            (namespace, key, now, now - self.maxAge))
+        return txn.fetchone()
+
+    def get(self, namespace, key):
+        """Return a `Deferred` firing with `(expiry, value)`, or None if `key` isn't stored.
+
+        Errors are logged and treated as the key not being stored.
+        """
+        pending = self._pending.get((namespace, key)) or self._flushingEntries.get((namespace, key))
+        if pending is not None:
+            return defer.succeed(pending)
+        d = self.pool.runInteraction(self._get, namespace, _storedKey(key), self.reactor.seconds())
+
+        @d.addCallback
+        def _cb(row):
+            if row is None:
+                return None
+            expires, value = row
+            return expires, cPickle.loads(str(value))
+
+        @d.addErrback
+        def _eb(f):
+            log.err(f, 'error reading %r from the persistent cache' % (key,))
+            return None
+
+        return d
+
+    def put(self, namespace, key, value, expiry=None):
+        "Store `value` for `key` with the next flush. An `expiry` of None never expires."
+        self._pending[namespace, key] = expiry, value
+
+    def _write(self, txn, rows):
+        txn.executemany(
+            'INSERT OR REPLACE INTO entries (namespace, key, value, expires, written) '
+            'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def flush(self):
+        "Write everything stored since the last flush."
+        if self._flushing is not None or not self._pending:
+            return self._flushing
+        pending = self._flushingEntries = self._pending
+        self._pending = {}
+        now = self.reactor.seconds()
+        rows = []
+        for (namespace, key), (expiry, value) in pending.iteritems():
+            try:
+                pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                log.err(None, 'error pickling %r for the persistent cache' % (key,))
+                continue
+            rows.append((namespace, _storedKey(key), buffer(pickled), expiry, now))
+        d = self._flushing = self.pool.runInteraction(self._write, rows)
+        d.addErrback(log.err, 'error writing to the persistent cache')
+
+        @d.addBoth
+        def _done(ign):
+            self._flushing = None
+            self._flushingEntries = {}
+
+        return d
+
+    def _prune(self, txn, now):
+        txn.execute(
+            'DELETE FROM entries WHERE expires <= ? OR written <= ?', (now, now - self.maxAge))
+        txn.execute(
+            'DELETE FROM entries WHERE rowid IN '
+            '(SELECT rowid FROM entries ORDER BY written DESC LIMIT -1 OFFSET ?)',
+            (self.maxEntries,))
+
+    def prune(self):
+        "Drop expired entries, and the oldest past `maxEntries`."
+        d = self.pool.runInteraction(self._prune, self.reactor.seconds())
+        d.addErrback(log.err, 'error pruning the persistent cache')
+        return d
+
+    def startService(self):
+        Service.startService(self)
+        self._flushLoop.start(self.flushInterval, now=False)
+        self._pruneLoop.start(self.pruneInterval)
+
+    def stopService(self):
+        "Flush what's left and close the database."
+        Service.stopService(self)
+        if self._flushLoop.running:
+            self._flushLoop.stop()
+        if self._pruneLoop.running:
+            self._pruneLoop.stop()
+        d = defer.maybeDeferred(self.flush)
+        d.addCallback(lambda ign: self.flush())
+        d.addBoth(lambda ign: self.pool.close())
+        return d
+
+class PersistentNamespace(object):
+    "One cache's view of a `PersistentStore`."
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def get(self, key):
+        return self.store.get(self.name, key)
+
+    def put(self, key, value, expiry=None):
+        self.store.put(self.name, key, value, expiry)
+
+class ExpiringCache(object):
+    """A bounded LRU cache whose entries expire.
+
+    Concurrent lookups of a key which isn't cached yet share a single fetch.
+    Results for which `isNegative` returns true, and failures, are kept for
+    `negativeTTL` seconds instead of `ttl` seconds; `Saturated` failures
+    aren't kept at all. With a `persistent`
+    namespace of a `PersistentStore`, entries other than failures are also
+    written there, and a miss checks there before fetching.
+    """
+    def __init__(self, reactor, maxSize=1024, ttl=3600, negativeTTL=300, isNegative=None,
+                 persistent=None):
+        self.reactor = reactor
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.isNegative = isNegative
+        self.persistent = persistent
+        self._entries = collections.OrderedDict()
+        self._inFlight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Return the cached value for `key`, or raise `KeyError`."
+        expiry, value = self._entries.pop(key)
+        if expiry <= self.reactor.seconds():
+            raise KeyError(key)
+        self._entries[key] = expiry, value
+        return value
+
+    def set(self, key, value, ttl=None):
+        "Cache `value` for `key`, evicting the least recently used entries."
+        if ttl is None:
+            ttl = self.ttl
+        expiry = self.reactor.seconds() + ttl
+        self._insert(key, expiry, value)
+        if self.persistent is not None and self._persistable(value):
+            self.persistent.put(key, value, expiry)
+
+    def _persistable(self, value):
+        return not isinstance(value, failure.Failure)
+
+    def _insert(self, key, expiry, value):
+        self._entries.pop(key, None)
+        self._entries[key] = expiry, value
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def _ttlFor(self, value):
+        if isinstance(value, failure.Failure):
+            return self.negativeTTL
+        if self.isNegative is not None and self.isNegative(value):
+            return self.negativeTTL
+        return self.ttl
+
+    def lookup(self, key, fetch, *args, **kwargs):
+        """Return a `Deferred` firing with the value for `key`.
+
+        On a miss, `fetch` is called with the remaining arguments unless a
+        fetch for the same key is already in flight.
+        """
+        try:
+            value = self.get(key)
+        except KeyError:
+            pass
+        else:
+            if isinstance(value, failure.Failure):
+                return defer.fail(value)
+            return defer.succeed(value)
+
+        waiter = defer.Deferred()
+        if key in self._inFlight:
+            self._inFlight[key].append(waiter)
+            return waiter
+        if self.persistent is None:
+            self._fetch(key, [waiter], fetch, args, kwargs)
+        else:
+            self._load(key, [waiter], fetch, args, kwargs)
+        return waiter
+
+    def _load(self, key, waiters, fetch, args, kwargs):
+        self._inFlight[key] = waiters
+
+        d = self.persistent.get(key)
+
+        @d.addCallback
+        def _loaded(entry):
+            if entry is not None:
+                self._insert(key, *entry)
+            try:
+                result = self.get(key)
+            except KeyError:
+                self._fetch(key, waiters, fetch, args, kwargs)
+                return
+            del self._inFlight[key]
+            for waiter in waiters:
+                waiter.callback(result)
+
+    def _fetch(self, key, waiters, fetch, args, kwargs):
+        self._inFlight[key] = waiters
+
+        def _done(result):
+            del self._inFlight[key]
+            if isinstance(result, failure.Failure):
+                result.cleanFailure()
+            # Local overload isn't worth remembering against the key.
+            if not (isinstance(result, failure.Failure) and result.check(Saturated)):
+                result = self._store(key, result)
+            for waiter in waiters:
+                waiter.callback(result)
+
+        defer.maybeDeferred(fetch, *args, **kwargs).addBoth(_done)
+
+    def _store(self, key, result):
+        self.set(key, result, self._ttlFor(result))
+        return result
+
+class RevalidatingCache(ExpiringCache):
+    """An `ExpiringCache` which keeps serving entries while refreshing them.
+
+    Entries are fresh for `ttl` seconds. For `staleTTL` seconds after that,
+    `lookup` still returns them immediately but also refetches them in the
+    background; if the refetch fails, the stale value is kept. At most
+    `concurrency` fetches run at once.
+    """
+    def __init__(self, reactor, maxSize=1024, ttl=600, staleTTL=86400, negativeTTL=300,
+                 isNegative=None, concurrency=2, persistent=None):
+        ExpiringCache.__init__(self, reactor, maxSize, ttl, negativeTTL, isNegative, persistent)
+        self.staleTTL = staleTTL
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self.counts = collections.Counter()
+
+    def get(self, key):
+        "Return the cached value for `key`, fresh or stale, or raise `KeyError`."
+        refreshAt, value = ExpiringCache.get(self, key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        staleTTL = 0 if isinstance(value, failure.Failure) else self.staleTTL
+        ExpiringCache.set(self, key, (self.reactor.seconds() + ttl, value), ttl + staleTTL)
+
+    def _persistable(self, entry):
+        refreshAt, value = entry
+        return ExpiringCache._persistable(self, value)
+
+    def _store(self, key, result):
+        if isinstance(result, failure.Failure) and key in self._entries:
+            expiry, (refreshAt, value) = self._entries[key]
+            if not isinstance(value, failure.Failure) and expiry > self.reactor.seconds():
+                # Keep serving the stale value, but don't retry immediately.
+                self.counts['refreshFailed'] += 1
+                refreshAt = self.reactor.seconds() + self.negativeTTL
+                self._entries[key] = expiry, (refreshAt, value)
+                return value
+        return ExpiringCache._store(self, key, result)
+
+    def lookup(self, key, fetch, *args, **kwargs):
+        """Return a `Deferred` firing with the value for `key`.
+
+        Stale entries fire immediately, and a refetch is started if there
+        isn't one in flight already.
+        """
+        try:
+            refreshAt, value = ExpiringCache.get(self, key)
+        except KeyError:
+            self.counts['miss'] += 1
+            return ExpiringCache.lookup(self, key, self._semaphore.run, fetch, *args, **kwargs)
+        if refreshAt > self.reactor.seconds():
+            self.counts['fresh'] += 1
+        else:
+            self.counts['stale'] += 1
+            if key not in self._inFlight:
+                self.counts['refresh'] += 1
+                self._fetch(key, [], self._semaphore.run, (fetch,) + args, kwargs)
+        if isinstance(value, failure.Failure):
+            return defer.fail(value)
+        return defer.succeed(value)
+
+class FetchScheduler(object):
+    """Limit how many fetches run at once, and for how long.
+
+    At most `globalLimit` fetches run concurrently, and at most `perHostLimit`
+    of those against any one host. A fetch which hasn't finished `timeout`
+    seconds after being scheduled, including time spent waiting for a slot,
+    is cancelled and fails with `defer.TimeoutError`, or with `Saturated` if
+    it was still waiting.
+    """
+    def __init__(self, reactor, globalLimit=16, perHostLimit=2, timeout=15):
+        self.reactor = reactor
+        self.perHostLimit = perHostLimit
+        self.timeout = timeout
+        self._globalLock = defer.DeferredSemaphore(globalLimit)
+        self._hostLocks = {}
+
+    def _hostLock(self, host):
+        lock = self._hostLocks.get(host)
+        if lock is None:
+            lock = self._hostLocks[host] = defer.DeferredSemaphore(self.perHostLimit)
+        return lock
+
+    def _maybeDropHostLock(self, host):
+        lock = self._hostLocks.get(host)
+        if lock is not None and lock.tokens == lock.limit and not lock.waiting:
+            del self._hostLocks[host]
+
+    def schedule(self, url, fetch, *args, **kwargs):
+        """Call `fetch` with the remaining arguments once a slot is free.
+
+        `url` determines which host's slots are used. Returns a `Deferred`
+        firing with the result of `fetch`.
+        """
+        host = urlparse.urlparse(url).hostname
+        acquired = []
+        started = []
+
+        def _acquired(lock):
+            acquired.append(lock)
+
+        def _fetch(ign):
+            started.append(True)
+            return fetch(*args, **kwargs)
+
+        def _release(result):
+            for lock in acquired:
+                lock.release()
+            self._maybeDropHostLock(host)
+            return result
+
+        d = self._hostLock(host).acquire()
+        d.addCallback(_acquired)
+        d.addCallback(lambda ign: self._globalLock.acquire())
+        d.addCallback(_acquired)
+        d.addCallback(_fetch)
+        d.addBoth(_release)
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self.reactor)
+
+            @d.addErrback
+            def _timedOut(f):
+                f.trap(defer.TimeoutError)
+                if not started:
+                    raise Saturated('no fetch slot for %s within %ds' % (host, self.timeout))
+                return f
+        return d
+
+def _schedule(scheduler, url, fetch, *args):
+    if scheduler is None:
+        return defer.maybeDeferred(fetch, *args)
+    return scheduler.schedule(url, fetch, *args)
+
+URLInfo = collections.namedtuple('URLInfo', 'results title ok redirects')
+
+defaultTitleByteLimit = 65536
+defaultSniffByteLimit = 4096
+
+def formatSize(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
+
+contentRangeRegex = re.compile(r'bytes\s+(?:\d+-\d+|\*)/(\d+)')
+
+def contentSize(resp):
+    "Figure out the full size of a response's entity, which might be ranged."
+    contentRange = resp.headers.getRawHeaders('content-range')
+    if contentRange:
+        m = contentRangeRegex.match(contentRange[0])
+        if m:
+            return int(m.group(1))
+    elif resp.length is not UNKNOWN_LENGTH:
+        return resp.length
+    return None
+
+def contentType(resp, url):
+    "Parse the Content-Type of a response, guessing from `url` if it's missing."
+    header = resp.headers.getRawHeaders('content-type')
+    if header:
+        return cgi.parse_header(header[0])
+    guessed, _ = mimetypes.guess_type(urlparse.urlparse(url).path)
+    return guessed or 'application/octet-stream', {}
+
+def _sniff(body):
+    return magic.from_buffer(body, mime=True)
+
+@defer.inlineCallbacks
+def sniffContent(resp, byteLimit=defaultSniffByteLimit, pool=None):
+    """Describe a non-HTML response from the first `byteLimit` bytes of it.
+
+    The rest of the body is never read. The description includes the type
+    libmagic detects, on `pool` if there is one, and the size of the entity,
+    if it's known.
+    """
+    body = yield receive(resp, StringReceiver(byteLimit))
+    try:
+        sniffed = yield _runIn(pool, 'sniff', _sniff, body)
+    except Exception:
+        log.err(None, 'error identifying content')
+        sniffed = None
+    size = contentSize(resp)
+    defer.returnValue(', '.join(
+        part for part in [sniffed, size is not None and formatSize(size)] if part))
+
 redirectsToFollow = set((301, 302, 303, 307))
+successfulStatuses = set((200, 206))
 @defer.inlineCallbacks
-def urlInfo(agent, url, redirectFollowCount=3, fullInfo=True):
+def _urlInfo(agent, url, redirectFollowCount=3, titleByteLimit=defaultTitleByteLimit,
+             sniffByteLimit=defaultSniffByteLimit, pool=None):
     results = [url]
+    title = None
+    ok = False
+    redirects = 0
+    # Only ask for as much of the body as is going to be looked at; a server
+    # which doesn't support ranges will just send a 200 instead of a 206.
+    headers = Headers({'range': ['bytes=0-%d' % (max(titleByteLimit, sniffByteLimit) - 1,)]})
     try:
         for _ in xrange(redirectFollowCount):
-            resp = yield agent.request('GET', url)
+            resp = yield agent.request('GET', url, headers)
             if resp.code in redirectsToFollow:
+                discard(resp)
                 url = resp.headers.getRawHeaders('location')[0]
                 results.append('%d: %s' % (resp.code, url))
+                redirects += 1
                 continue
-            elif resp.code == 200:
-                content_type, params = cgi.parse_header(resp.headers.getRawHeaders('content-type')[0])
+            elif resp.code in successfulStatuses:
+                ok = True
+                content_type, params = contentType(resp, url)
                 result = '%d: %s' % (resp.code, content_type)
                 if content_type == 'text/html':
-                    body = yield receive(resp, StringReceiver(4096))
-                    if 'charset' in params:
-                        body = body.decode(params['charset'].strip('"\''), 'replace')
-                    doc = html.fromstring(body)
-                    title_nodes = doc.xpath('//title/text()')
-                    if title_nodes:
-                        title = ' '.join(title_nodes[0].split())
-                        if not fullInfo:
-                            defer.returnValue(title)
+                    charset = params.get('charset', '').strip('"\'') or None
+                    body = yield receive(resp, TitleReceiver(titleByteLimit))
+                    title = yield _runIn(pool, 'title', parseTitle, body, charset)
+                    if title is not None:
+                        title = ' '.join(title.split())
                         result = '%s -- %s' % (result, title)
+                else:
+                    sniffed = yield sniffContent(resp, sniffByteLimit, pool)
+                    if sniffed:
+                        result = '%s -- %s' % (result, sniffed)
                 results.append(result)
                 break
             else:
+                discard(resp)
                 results.append(str(resp.code))
                 break
+    except (defer.CancelledError, Saturated):
+        raise
     except Exception:
+        if twits.wasCancelled(failure.Failure()):
+            # Unwrapped, so that a scheduler timeout still becomes a TimeoutError.
+            raise defer.CancelledError()
         log.err(None, 'error in URL info for %r' % (url,))
         results.append(traceback.format_exc(limit=0).splitlines()[-1])
+        ok = False
+    defer.returnValue(URLInfo(results, title, ok, redirects))
+
+def formatURLInfo(info, fullInfo=True):
     if not fullInfo:
-        defer.returnValue(None)
-    defer.returnValue(' => '.join(results))
+        return info.title
+    return ' => '.join(info.results)
+
+def _countURLInfo(info, metrics):
+    metrics.count('url.redirects', info.redirects)
+    if not info.ok:
+        metrics.count('url.notOK')
+    return info
+
+def _timedURLInfo(metrics, *args):
+    d = metrics.timeCall('url.fetch', _schedule, *args)
+    d.addCallback(_countURLInfo, metrics)
+    return d
+
+def urlInfo(agent, url, redirectFollowCount=3, fullInfo=True, cache=None,
+            titleByteLimit=defaultTitleByteLimit, scheduler=None,
+            sniffByteLimit=defaultSniffByteLimit, metrics=None, pool=None):
+    args = (scheduler, url, _urlInfo, agent, url, redirectFollowCount,
+            titleByteLimit, sniffByteLimit, pool)
+    fetch = _schedule
+    if metrics is not None:
+        fetch = _timedURLInfo
+        args = (metrics,) + args
+    if cache is None:
+        d = fetch(*args)
+    else:
+        d = cache.lookup(url, fetch, *args)
+    d.addCallback(formatURLInfo, fullInfo)
+    return d
+
+gyazoOEmbed = 'https://api.gyazo.com/api/oembed?url='
 
 @defer.inlineCallbacks
-def gyazoImage(agent, url):
-    resp = yield agent.request('GET', url)
+def _gyazoImage(agent, oembedURL, byteLimit):
+    resp = yield agent.request('GET', oembedURL)
     if resp.code != 200:
-        log.msg('non-200 (%d) response from %r' % (resp.code, url))
+        discard(resp)
+        log.msg('non-200 (%d) response from %r' % (resp.code, oembedURL))
         return
-    body = yield receive(resp, StringReceiver(16384))
-    doc = html.fromstring(body)
-    image, = doc.xpath('//img[@id="gyazo_img"]/@src')
-    defer.returnValue(urlparse.urljoin(url, image))
+    oembed = yield receive(resp, JSONReceiver(byteLimit))
+    defer.returnValue(oembed['url'])
+
+def gyazoImage(agent, url, scheduler=None, byteLimit=4096):
+    "Find the image on a gyazo page through gyazo's oEmbed endpoint."
+    oembedURL = gyazoOEmbed + urllib.quote(url, safe='')
+    return _schedule(scheduler, oembedURL, _gyazoImage, agent, oembedURL, byteLimit)
+
+def tahoeCheck(agent, tahoe, uri, byteLimit=262144):
+    d = agent.request('POST', tahoe + urllib.quote(uri) + '?t=check&output=json')
+    d.addCallback(receive, JSONReceiver(byteLimit))
+    return d
+
+class LinkResolver(object):
+    """Describes links to `name` better than their page title would.
+
+    Links to any of `hosts`, or their subdomains, are passed to `key`, which
+    returns what to cache the result under, or None if the link is better off
+    as a plain page title. `fetch` is called with the factory, the link and the
+    key; it's cancelled after `timeout` seconds and its result is cached for
+    `ttl` seconds, or not at all if `ttl` is None. Results for which
+    `isNegative` returns true are only cached for `negativeTTL` seconds.
+    `format` turns the result into a message for a protocol.
+    """
+    name = None
+    hosts = ()
+    ttl = 3600
+    negativeTTL = 300
+    byteLimit = 65536
+    timeout = 15
+
+    def key(self, url):
+        return url
+
+    def fetch(self, factory, url, key):
+        raise NotImplementedError()
+
+    def isNegative(self, result):
+        return result is None
+
+    def format(self, protocol, result):
+        raise NotImplementedError()
+
+class TwitterResolver(LinkResolver):
+    name = 'twitter'
+    hosts = 'twitter.com',
+    # Twitter already caches tweets and their rendering.
+    ttl = None
+
+    def key(self, url):
+        m = twitter_regexp.search(url)
+        return m and m.group(1)
+
+    def fetch(self, factory, url, id):
+        return factory.twits.lookupTwit(id)
+
+    def format(self, protocol, twit):
+        return protocol.formatTwit(twit)
+
+class GyazoResolver(LinkResolver):
+    name = 'gyazo'
+    hosts = 'gyazo.com',
+    ttl = 86400
+    byteLimit = 4096
+    timeout = 10
+
+    def key(self, url):
+        m = gyazo_regexp.match(url)
+        return m and m.group()
+
+    def fetch(self, factory, url, key):
+        return gyazoImage(factory.agent, key, factory.scheduler, self.byteLimit)
+
+    def format(self, protocol, image):
+        if image is not None:
+            return c(' Gyazo ', WHITE, NAVY) + ' ' + b(escapeControls(image))
+
+class LinkResolvers(object):
+    "Dispatches links to the `LinkResolver` registered for their host."
+    def __init__(self, reactor, resolvers=(), maxSize=1024):
+        self.reactor = reactor
+        self.maxSize = maxSize
+        self._byHost = {}
+        self._caches = {}
+        for resolver in resolvers:
+            self.register(resolver)
+
+    def register(self, resolver):
+        for host in resolver.hosts:
+            self._byHost[host.lower()] = resolver
+        if resolver.ttl is not None:
+            self._caches[resolver] = ExpiringCache(
+                self.reactor, self.maxSize, resolver.ttl, resolver.negativeTTL,
+                isNegative=resolver.isNegative)
+
+    def resolverFor(self, host):
+        "Return the resolver for `host` or the nearest domain above it, or None."
+        labels = host.lower().split('.')
+        for i in xrange(len(labels) - 1):
+            resolver = self._byHost.get('.'.join(labels[i:]))
+            if resolver is not None:
+                return resolver
+        return None
 
-urlRegex = re.compile(
-    u'(?isu)(\\b(?:https?://|www\\d{0,3}[.]|[a-z0-9.\\-]+[.][a-z]{2,4}/)[^\\s()<'
+    def _fetch(self, resolver, factory, url, key):
+        d = factory.metrics.timeCall('resolve.' + resolver.name, resolver.fetch, factory, url, key)
+        if resolver.timeout is not None:
+            d.addTimeout(resolver.timeout, self.reactor)
+        return d
+
+    def resolve(self, protocol, url):
+        """Return a `Deferred` firing with a message describing `url`.
+
+        Returns None if no resolver handles `url`.
+        """
+        host = urlparse.urlparse(url).hostname
+        resolver = host and self.resolverFor(host)
+        if not resolver:
+            return None
+        key = resolver.key(url)
+        if key is None:
+            return None
+        cache = self._caches.get(resolver)
+        if cache is None:
+            d = self._fetch(resolver, protocol.factory, url, key)
+        else:
+            d = cache.lookup(key, self._fetch, resolver, protocol.factory, url, key)
+        d.addCallback(lambda result: resolver.format(protocol, result))
+        return d
+
+urlPattern = (
+    u'(\\b(?:https?://|www\\d{0,3}[.]|[a-z0-9.\\-]+[.][a-z]{2,4}/)[^\\s()<'
     u'>\\[\\]]+[^\\s`!()\\[\\]{};:\'".,<>?\xab\xbb\u201c\u201d\u2018\u2019])'
 )
+urlRegex = re.compile(u'(?isu)' + urlPattern)
 
-tahoeRegex = re.compile(
+tahoePattern = (
     '(URI:(?:(?:CHK|DIR2(?:-MDMF)?(?:-(?:CHK|LIT|RO))?|LIT|(?:SSK|MDMF)(?:-RO)'
     '?):)[A-Za-z0-9:]+)'
 )
+tahoeRegex = re.compile(tahoePattern)
+
+# Both of the above in one pass. The flags apply to the whole pattern, so a
+# 'tahoe' match still has to be checked for the case-sensitive prefix.
+linkRegex = re.compile(u'(?isu)(?P<url>%s)|(?P<tahoe>%s)' % (urlPattern, tahoePattern))
+
+def mightContainLinks(message):
+    "A cheap check for whether `linkRegex` could possibly match `message`."
+    return '/' in message or 'URI:' in message or 'www' in message.lower()
+
+PRIORITY_COMMAND, PRIORITY_LINK, PRIORITY_STREAM = range(3)
+
+class OutputScheduler(object):
+    """Send messages at a rate the server won't consider flooding.
+
+    Messages are sent from a token bucket which refills at `rate` tokens per
+    second up to `burst` tokens. Queued messages are sent in order of priority,
+    taking turns between channels with the same priority. Once more than
+    `maxStreamBacklog` stream messages are waiting for one channel, the oldest
+    of them are dropped.
+    """
+    def __init__(self, reactor, send, rate=0.5, burst=5, maxStreamBacklog=5, metrics=None):
+        self.reactor = reactor
+        self.send = send
+        self.metrics = metrics
+        self.rate = rate
+        self.burst = burst
+        self.maxStreamBacklog = maxStreamBacklog
+        self._tokens = burst
+        self._lastRefill = reactor.seconds()
+        self._queues = [collections.OrderedDict() for _ in xrange(PRIORITY_STREAM + 1)]
+        self._sendCall = None
+        self.sent = 0
+        self.dropped = 0
+        self.totalWait = 0
+        self.maxWait = 0
+
+    def enqueue(self, channel, message, priority=PRIORITY_COMMAND):
+        "Queue `message` to be sent to `channel`."
+        queue = self._queues[priority].get(channel)
+        if queue is None:
+            queue = self._queues[priority][channel] = collections.deque()
+        queue.append((self.reactor.seconds(), message))
+        if priority == PRIORITY_STREAM:
+            while len(queue) > self.maxStreamBacklog:
+                queue.popleft()
+                self.dropped += 1
+        self._pump()
+
+    def _refill(self):
+        now = self.reactor.seconds()
+        self._tokens = min(self.burst, self._tokens + (now - self._lastRefill) * self.rate)
+        self._lastRefill = now
+
+    def _next(self):
+        for queues in self._queues:
+            if not queues:
+                continue
+            channel, queue = queues.popitem(last=False)
+            enqueued, message = queue.popleft()
+            if queue:
+                queues[channel] = queue
+            return channel, enqueued, message
+        return None
+
+    def _pump(self):
+        if self._sendCall is not None:
+            return
+        self._refill()
+        while self._tokens >= 1:
+            item = self._next()
+            if item is None:
+                return
+            channel, enqueued, message = item
+            self._tokens -= 1
+            wait = self.reactor.seconds() - enqueued
+            self.sent += 1
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+            if self.metrics is not None:
+                self.metrics.observe('output.wait', wait)
+            self.send(channel, message)
+        if self.depth():
+            self._sendCall = self.reactor.callLater((1 - self._tokens) / self.rate, self._wake)
+
+    def _wake(self):
+        self._sendCall = None
+        self._pump()
+
+    def depth(self, channel=None):
+        "How many messages are waiting, optionally only for one `channel`."
+        if channel is None:
+            return sum(len(queue) for queues in self._queues for queue in queues.itervalues())
+        return sum(len(queues.get(channel, ())) for queues in self._queues)
+
+    def oldestWait(self):
+        "How long the oldest waiting message has been waiting."
+        enqueued = [queue[0][0] for queues in self._queues for queue in queues.itervalues()]
+        if not enqueued:
+            return 0
+        return self.reactor.seconds() - min(enqueued)
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'meanWait': self.totalWait / self.sent if self.sent else 0,
+            'maxWait': self.maxWait,
+            'oldestWait': self.oldestWait(),
+        }
+
+    def stop(self):
+        "Stop sending and forget about everything still queued."
+        if self._sendCall is not None:
+            self._sendCall.cancel()
+            self._sendCall = None
+        for queues in self._queues:
+            queues.clear()
+
+SHED_NOTHING, SHED_UNCACHED_TITLES, SHED_GENERIC_LINKS, SHED_EVERYTHING = range(4)
+
+class LinkShedder(object):
+    """Decide how much passive link expansion to do while busy.
+
+    The level comes from how many scans are in flight and how long recent
+    scans took, compared against the thresholds for each level in turn: first
+    page titles are only given from the cache, then links without a resolver
+    are skipped entirely, then nothing is expanded. Separately, a channel
+    with `perChannel` scans in flight has nothing expanded. The recent
+    latency decays with a half-life of `halfLife` seconds, so it recovers
+    once scanning stops.
+    """
+    def __init__(self, reactor, inFlightLevels=(16, 32, 64), latencyLevels=(5, 10, 20),
+                 perChannel=4, smoothing=0.2, halfLife=30, metrics=None):
+        self.reactor = reactor
+        self.inFlightLevels = inFlightLevels
+        self.latencyLevels = latencyLevels
+        self.perChannel = perChannel
+        self.smoothing = smoothing
+        self.halfLife = halfLife
+        self.metrics = metrics
+        self.inFlight = 0
+        self._channelInFlight = collections.Counter()
+        self._latency = 0.
+        self._latencyAt = reactor.seconds()
+        self.counts = collections.Counter()
+
+    def latency(self):
+        "The smoothed latency of recent scans, decayed since the last one."
+        elapsed = self.reactor.seconds() - self._latencyAt
+        return self._latency * 0.5 ** (elapsed / self.halfLife)
+
+    def level(self, channel=None):
+        if channel is not None and self._channelInFlight[channel] >= self.perChannel:
+            return SHED_EVERYTHING
+        latency = self.latency()
+        level = SHED_NOTHING
+        for shedLevel, maxInFlight, maxLatency in zip(
+                xrange(SHED_UNCACHED_TITLES, SHED_EVERYTHING + 1),
+                self.inFlightLevels, self.latencyLevels):
+            if self.inFlight >= maxInFlight or latency >= maxLatency:
+                level = shedLevel
+        return level
+
+    def shed(self, what):
+        "Count one decision not to expand something."
+        self.counts[what] += 1
+        if self.metrics is not None:
+            self.metrics.count('shed.' + what)
+
+    def started(self, channel):
+        self.inFlight += 1
+        self._channelInFlight[channel] += 1
+        return self.reactor.seconds()
+
+    def finished(self, channel, startedAt):
+        self.inFlight -= 1
+        self._channelInFlight[channel] -= 1
+        if not self._channelInFlight[channel]:
+            del self._channelInFlight[channel]
+        now = self.reactor.seconds()
+        self._latency = self.latency() * (1 - self.smoothing) + (now - startedAt) * self.smoothing
+        self._latencyAt = now
+
+    def stats(self):
+        return dict(
+            self.counts,
+            level=self.level(),
+            inFlight=self.inFlight,
+            latency=self.latency())
+
+caseMappings = {
+    'ascii': string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+    'strict-rfc1459': string.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+}
+
+class ChannelMembership(object):
+    """Track which nicks are in which channels.
+
+    Both channel->nicks and nick->channels are indexed, so forgetting or
+    renaming a nick only touches the channels it's in. Nicks and channels are
+    case-folded according to the server's CASEMAPPING.
+    """
+    def __init__(self, caseMapping='rfc1459'):
+        self._table = caseMappings.get(caseMapping, caseMappings['rfc1459'])
+        self._channelNicks = {}
+        self._nickChannels = {}
+        self._names = {}
+
+    def setCaseMapping(self, caseMapping):
+        "Switch to another CASEMAPPING, re-folding everything already tracked."
+        table = caseMappings.get(caseMapping, caseMappings['rfc1459'])
+        if table == self._table:
+            return
+        self._table = table
+        memberships = [
+            (channel, self._names[folded])
+            for channel, nicks in self._channelNicks.iteritems() for folded in nicks]
+        self._channelNicks = {}
+        self._nickChannels = {}
+        self._names = {}
+        for channel, nick in memberships:
+            self.add(channel, nick)
+
+    def fold(self, name):
+        return intern(name.translate(self._table))
+
+    def add(self, channel, nick):
+        channel, folded = self.fold(channel), self.fold(nick)
+        self._channelNicks.setdefault(channel, set()).add(folded)
+        self._nickChannels.setdefault(folded, set()).add(channel)
+        self._names[folded] = intern(nick)
+
+    def _discard(self, channel, folded):
+        nicks = self._channelNicks.get(channel)
+        if nicks is not None:
+            nicks.discard(folded)
+            if not nicks:
+                del self._channelNicks[channel]
+        channels = self._nickChannels.get(folded)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._nickChannels[folded]
+                del self._names[folded]
+
+    def discard(self, channel, nick):
+        self._discard(self.fold(channel), self.fold(nick))
+
+    def forgetNick(self, nick):
+        folded = self.fold(nick)
+        for channel in self._nickChannels.pop(folded, ()):
+            self._channelNicks[channel].discard(folded)
+            if not self._channelNicks[channel]:
+                del self._channelNicks[channel]
+        self._names.pop(folded, None)
+
+    def forgetChannel(self, channel):
+        channel = self.fold(channel)
+        for folded in list(self._channelNicks.get(channel, ())):
+            self._discard(channel, folded)
+
+    def rename(self, oldname, newname):
+        oldFolded, newFolded = self.fold(oldname), self.fold(newname)
+        channels = self._nickChannels.pop(oldFolded, None)
+        self._names.pop(oldFolded, None)
+        if channels is None:
+            return
+        for channel in channels:
+            nicks = self._channelNicks[channel]
+            nicks.discard(oldFolded)
+            nicks.add(newFolded)
+        self._nickChannels.setdefault(newFolded, set()).update(channels)
+        self._names[newFolded] = intern(newname)
+
+    def nicks(self, channel):
+        "The nicks in `channel`, as they were last seen."
+        return set(self._names[folded] for folded in self._channelNicks.get(self.fold(channel), ()))
+
+    def channels(self, nick):
+        "The case-folded names of the channels `nick` is in."
+        return set(self._nickChannels.get(self.fold(nick), ()))
+
+    def __contains__(self, membership):
+        channel, nick = membership
+        return self.fold(nick) in self._channelNicks.get(self.fold(channel), ())
 
 class _IRCBase(irc.IRCClient):
     def ctcpQuery(self, user, channel, messages):
@@ -136,36 +1581,51 @@ class _IRCBase(irc.IRCClient):
     def noticed(self, user, channel, message):
         pass
 
-    def signedOn(self):
-        self.channelUsers = collections.defaultdict(set)
+    def connectionMade(self):
+        irc.IRCClient.connectionMade(self)
+        self.channelUsers = ChannelMembership()
+        self._updateSupported()
+
+    def isupport(self, options):
+        # Servers send ISUPPORT after RPL_WELCOME, possibly in several parts.
+        self._updateSupported()
+
+    def _updateSupported(self):
+        caseMapping, = self.supported.getFeature('CASEMAPPING', ('rfc1459',))
+        self.channelUsers.setCaseMapping(caseMapping)
         self.nickPrefixes = ''.join(prefix for prefix, _ in self.supported.getFeature('PREFIX').itervalues())
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = params[2].lower()
-        self.channelUsers[channel].update(nick.lstrip(self.nickPrefixes) for nick in params[3].split(' '))
+        channel = params[2]
+        for nick in params[3].split(' '):
+            nick = nick.lstrip(self.nickPrefixes)
+            if nick:
+                self.channelUsers.add(channel, nick)
 
     def userJoined(self, user, channel):
         nick, _, host = user.partition('!')
-        self.channelUsers[channel.lower()].add(nick)
+        self.channelUsers.add(channel, nick)
 
     def userLeft(self, user, channel):
         nick, _, host = user.partition('!')
-        self.channelUsers[channel.lower()].discard(nick)
+        self.channelUsers.discard(channel, nick)
 
     def userQuit(self, user, quitMessage):
         nick, _, host = user.partition('!')
-        for users in self.channelUsers.itervalues():
-            users.discard(nick)
+        self.channelUsers.forgetNick(nick)
 
     def userKicked(self, kickee, channel, kicker, message):
         nick, _, host = kickee.partition('!')
-        self.channelUsers[channel.lower()].discard(nick)
+        self.channelUsers.discard(channel, nick)
 
     def userRenamed(self, oldname, newname):
-        for users in self.channelUsers.itervalues():
-            if oldname in users:
-                users.discard(oldname)
-                users.add(newname)
+        self.channelUsers.rename(oldname, newname)
+
+    def left(self, channel):
+        self.channelUsers.forgetChannel(channel)
+
+    def kickedFrom(self, channel, kicker, message):
+        self.channelUsers.forgetChannel(channel)
 
 class TheresaProtocol(_IRCBase):
     _lastURL = None
@@ -178,46 +1638,109 @@ class TheresaProtocol(_IRCBase):
     versionNum = 'HEAD'
     versionEnv = 'twisted'
 
+    outputRate = 0.5
+    outputBurst = 5
+    outputStreamBacklog = 5
+
+    _streamDelegate = None
+
     def __init__(self):
         if self.channels is None:
             self.channels = self.channel,
+        self._addressedNick = None
+        self._addressedRegex = None
+        self._commands = dict(
+            (name[len('command_'):], getattr(self, name))
+            for name in dir(self) if name.startswith('command_'))
+
+    def addressedRegex(self):
+        "A regex matching messages addressed to the current nickname."
+        if self._addressedNick != self.nickname:
+            self._addressedRegex = re.compile(
+                r'(?i)^\s*%s\s*[,:> ]+(\S?.*?)[.!?]?\s*$' % (re.escape(self.nickname),))
+            self._addressedNick = self.nickname
+        return self._addressedRegex
+
+    def connectionMade(self):
+        self.outputScheduler = OutputScheduler(
+            self.factory.reactor, self.msg, self.outputRate, self.outputBurst,
+            self.outputStreamBacklog, self.factory.metrics)
+        self.factory.metrics.gauges['output'] = self.outputScheduler.stats
+        self._recall()
+        _IRCBase.connectionMade(self)
+
+    def connectionLost(self, reason):
+        if self._streamDelegate is not None:
+            self.factory.streamer.removeDelegate(self._streamDelegate)
+            self._streamDelegate = None
+        self.outputScheduler.stop()
+        if self.factory.metrics.gauges.get('output') == self.outputScheduler.stats:
+            del self.factory.metrics.gauges['output']
+        _IRCBase.connectionLost(self, reason)
 
     def signedOn(self):
-        self.join(','.join(self.channels))
+        channels = [channel for channel in self.channels if channel]
+        if channels:
+            self.join(','.join(channels))
         _IRCBase.signedOn(self)
+        if self.factory.streamer is not None and self.factory.streamChannels:
+            self._streamDelegate = self.twitDelegate(self.factory.streamChannels)
+            self.factory.streamer.addDelegate(self._streamDelegate)
+
+    def _remember(self, key, value):
+        if self.factory.context is not None:
+            self.factory.context.put(key, value)
+
+    def _recall(self):
+        "Pick up the context from before a restart, unless there's newer context already."
+        context = self.factory.context
+        if context is None:
+            return
+
+        def _gotURL(entry):
+            if entry is not None and self._lastURL is None:
+                self._lastURL = entry[1]
+
+        def _gotTwit(entry):
+            if entry is not None and self.lastTwitID is None:
+                self.lastTwitID, self.lastTwitUser = entry[1]
+
+        context.get('lastURL').addCallback(_gotURL)
+        context.get('lastTwit').addCallback(_gotTwit)
 
     def formatTwit(self, twit):
         self.lastTwitID = twit['id']
         self.lastTwitUser = twit['user']['screen_name']
+        self._remember('lastTwit', (self.lastTwitID, self.lastTwitUser))
         return ' '.join([
                 c(' Twitter ', WHITE, CYAN),
                 b('@%s:' % (escapeControls(twit['user']['screen_name']),)),
-                escapeControls(twits.extractRealTwitText(twit))])
+                self.factory.twits.renderTwitText(twit)])
 
-    def fetchFormattedTwit(self, id):
-        return (self.factory.twits
-                .request('statuses/show.json', id=id, include_entities='true')
-                .addCallback(self.formatTwit))
+    def twitDelegate(self, channels):
+        def _delegate(twit):
+            if 'timestamp_ms' in twit:
+                self.factory.metrics.observe(
+                    'stream.lag', self.factory.reactor.seconds() - int(twit['timestamp_ms']) / 1000.)
+            self.messageChannels(self.formatTwit(twit), channels, PRIORITY_STREAM)
+        return _delegate
 
     def fetchURLInfo(self, url, fullInfo=False):
-        d = urlInfo(self.factory.agent, url, fullInfo=fullInfo)
+        d = urlInfo(self.factory.agent, url, fullInfo=fullInfo, cache=self.factory.urlInfoCache,
+                    titleByteLimit=self.factory.titleByteLimit, scheduler=self.factory.scheduler,
+                    sniffByteLimit=self.factory.sniffByteLimit, metrics=self.factory.metrics,
+                    pool=self.factory.parsePool)
         @d.addCallback
         def _cb(r):
             if r is not None:
                 return c(' Page title ', WHITE, NAVY) + ' ' + b(escapeControls(r))
         self._lastURL = url
-        return d
-
-    def fetchGyazoImage(self, url):
-        d = gyazoImage(self.factory.agent, url)
-        @d.addCallback
-        def _cb(r):
-            if r is not None:
-                return c(' Gyazo ', WHITE, NAVY) + ' ' + b(escapeControls(r))
+        self._remember('lastURL', url)
         return d
 
     def _formatTahoe(self, data):
-        results = data['results']
+        # The check results may be cached, so don't modify them in place.
+        results = dict(data['results'])
         results['healthy'] = 'healthy' if results['healthy'] else 'unhealthy'
         results['recoverable'] = 'recoverable' if results['recoverable'] else 'unrecoverable'
         message = (
@@ -227,42 +1750,77 @@ class TheresaProtocol(_IRCBase):
         ).format(results)
         return c(' Tahoe-LAFS ', WHITE, CYAN) + ' ' + message.encode()
 
+    def _checkTahoe(self, uri):
+        if not self.factory.tahoe:
+            return None
+        # Networks on different grids may share the cache, so key by gateway.
+        d = self.factory.tahoeCheckCache.lookup(
+            (self.factory.tahoe, uri), self.factory.metrics.timeCall, 'tahoe.check',
+            _schedule, self.factory.scheduler, self.factory.tahoe,
+            tahoeCheck, self.factory.agent, self.factory.tahoe, uri)
+        d.addCallback(self._formatTahoe)
+        return d
+
     def _scanTahoe(self, message):
         if not self.factory.tahoe:
             return
         for m in tahoeRegex.finditer(message):
-            uri = m.group()
-            d = self.factory.agent.request(
-                'POST', self.factory.tahoe + urllib.quote(uri) + '?t=check&output=json')
-            d.addCallback(receive, StringReceiver())
-            d.addCallback(json.loads)
-            d.addCallback(self._formatTahoe)
-            yield d
+            yield self._checkTahoe(m.group())
+
+    def _scanURL(self, url, level=SHED_NOTHING):
+        if not url.startswith(('http://', 'https://')):
+            url = 'http://' + url
+        d = self.factory.linkResolvers.resolve(self, url)
+        if d is not None:
+            return d
+        shedder = self.factory.linkShedder
+        if level >= SHED_GENERIC_LINKS:
+            shedder.shed('genericLink')
+            return None
+        if level >= SHED_UNCACHED_TITLES:
+            try:
+                self.factory.urlInfoCache.get(url)
+            except KeyError:
+                shedder.shed('uncachedTitle')
+                return None
+        return self.fetchURLInfo(url)
+
+    def _scanFailed(self, f):
+        if f.check(Saturated):
+            self.factory.linkShedder.shed('saturated')
+            return None
+        log.err(f)
 
     def scanMessage(self, channel, message):
+        shedder = self.factory.linkShedder
+        shedKey = self.factory.name, channel
+        level = shedder.level(shedKey)
+        if level >= SHED_EVERYTHING:
+            shedder.shed('message')
+            return
         scannedDeferreds = []
-        for m in urlRegex.finditer(message):
-            url = m.group(0)
-            twitter_match = twitter_regexp.search(url)
-            if twitter_match:
-                scannedDeferreds.append(self.fetchFormattedTwit(twitter_match.group(1)))
-                continue
-            if not url.startswith(('http://', 'https://')):
-                url = 'http://' + url
-            if gyazo_regexp.match(url):
-                scannedDeferreds.append(self.fetchGyazoImage(url))
-                continue
-            scannedDeferreds.append(self.fetchURLInfo(url))
-        scannedDeferreds.extend(self._scanTahoe(message))
-        scannedDeferreds = [d.addErrback(log.err) for d in scannedDeferreds if d]
+        for m in linkRegex.finditer(message):
+            url, uri = m.group('url', 'tahoe')
+            if url:
+                scannedDeferreds.append(self._scanURL(url, level))
+                if 'URI:' in url:
+                    scannedDeferreds.extend(self._scanTahoe(url))
+            elif uri.startswith('URI:'):
+                scannedDeferreds.append(self._checkTahoe(uri))
+        scannedDeferreds = [d.addErrback(self._scanFailed) for d in scannedDeferreds if d]
         if not scannedDeferreds:
             return
+        startedAt = shedder.started(shedKey)
         d = defer.gatherResults(scannedDeferreds, consumeErrors=True)
         @d.addCallback
         def _cb(results):
             result = u' \xa6 '.encode('utf-8').join(result for result in results if result is not None)
-            if result is not None:
-                self.msg(channel, result)
+            if result:
+                self.outputScheduler.enqueue(channel, result, PRIORITY_LINK)
+        @d.addBoth
+        def _finished(result):
+            shedder.finished(shedKey, startedAt)
+            return result
         return d
 
     def personallyAddressed(self, user, channel, message):
@@ -272,32 +1830,50 @@ class TheresaProtocol(_IRCBase):
         if not channel.startswith('#'):
             return
 
-        addressedMatch = re.match(r'(?i)^s*%s\s*[,:> ]+(\S?.*?)[.!?]?\s*$' % (re.escape(self.nickname),), message)
+        addressedMatch = self.addressedRegex().match(message)
         if addressedMatch:
             self.personallyAddressed(user, channel, addressedMatch.group(1))
             return
 
         if not message.startswith((',', '!')):
-            defer.maybeDeferred(self.scanMessage, channel, message).addErrback(log.err)
+            if mightContainLinks(message):
+                (self.factory.metrics.timeCall('scan', self.scanMessage, channel, message)
+                 .addErrback(log.err))
             return
 
-        splut = shlex.split(message[1:])
+        rest = message[1:]
+        if '"' in rest or "'" in rest or '\\' in rest:
+            splut = shlex.split(rest)
+        else:
+            splut = rest.split()
+        if not splut:
+            return
         command, params = splut[0], splut[1:]
-        meth = getattr(self, 'command_%s' % (command.lower(),), None)
+        meth = self._commands.get(command.lower())
         if meth is not None:
             if command == 'dongcc':
                 d = defer.maybeDeferred(meth, channel, user, *params)
             else:
                 d = defer.maybeDeferred(meth, channel, *params)
+            self.factory.metrics.timed('command.' + command.lower(), d)
             @d.addErrback
             def _eb(f):
-                self.msg(channel, '%s in %s: %s' % (c(' Error ', YELLOW, RED), command, f.getErrorMessage()))
+                self.outputScheduler.enqueue(
+                    channel, '%s in %s: %s' % (c(' Error ', YELLOW, RED), command, f.getErrorMessage()))
                 return f
             d.addErrback(log.err)
 
-    def messageChannels(self, message, channels):
+    def messageChannels(self, message, channels, priority=PRIORITY_COMMAND):
         for channel in channels:
-            self.msg(channel, message)
+            self.outputScheduler.enqueue(channel, message, priority)
+
+    def command_queue(self, channel):
+        stats = self.outputScheduler.stats()
+        message = (
+            '{depth} waiting ({channelDepth} here), {sent} sent, {dropped} dropped; '
+            'wait mean {meanWait:.1f}s, max {maxWait:.1f}s, oldest {oldestWait:.1f}s'
+        ).format(channelDepth=self.outputScheduler.depth(channel), **stats)
+        self.messageChannels(message, [channel])
 
     def command_twit(self, channel, user):
         return (self.factory.twits
@@ -368,13 +1944,184 @@ class TheresaProtocol(_IRCBase):
         return (self.fetchURLInfo(url, fullInfo=True)
                 .addCallback(self.messageChannels, [channel]))
 
+    maxStatsLines = 8
+
+    def command_stats(self, channel, prefix=''):
+        lines = self.factory.metrics.summaryLines(prefix)
+        if self.factory.twits.metrics is not self.factory.metrics:
+            lines.extend(self.factory.twits.metrics.summaryLines(prefix))
+        if not lines:
+            lines = ['nothing recorded yet']
+        elif len(lines) > self.maxStatsLines:
+            more = len(lines) - self.maxStatsLines + 1
+            lines = lines[:self.maxStatsLines - 1] + [
+                '... and %d more; give a prefix to narrow it down' % (more,)]
+        for line in lines:
+            self.outputScheduler.enqueue(channel, line)
+
 class TheresaFactory(protocol.ReconnectingClientFactory):
+    """Connects a `TheresaProtocol` to one IRC network.
+
+    `nickname` and `channels`, if given, override the protocol's. Tweets
+    from `streamer`, a `twits.StreamPreserver`, are sent to `streamChannels`
+    while connected. `name` distinguishes the network's remembered context
+    and shedding from other networks in the same process.
+    """
     protocol = TheresaProtocol
+    titleByteLimit = defaultTitleByteLimit
+    sniffByteLimit = defaultSniffByteLimit
 
-    def __init__(self, agent, twits, tahoe=None, reactor=None):
+    def __init__(self, agent, twits, tahoe=None, reactor=None, urlInfoCache=None, scheduler=None,
+                 tahoeCheckCache=None, linkResolvers=None, metrics=None, persistentStore=None,
+                 parsePool=None, linkShedder=None, name=None, nickname=None, channels=None,
+                 streamer=None, streamChannels=()):
         self.agent = agent
         self.twits = twits
         self.tahoe = tahoe
+        self.name = name
+        self.nickname = nickname
+        self.channels = channels
+        self.streamer = streamer
+        self.streamChannels = streamChannels
         if reactor is None:
             from twisted.internet import reactor
         self.reactor = reactor
+        if metrics is None:
+            metrics = twits.metrics
+        self.metrics = metrics
+        self.context = None
+        urlInfoStore = tahoeCheckStore = None
+        if persistentStore is not None:
+            self.context = persistentStore.namespace(
+                'context' if name is None else 'context:' + name)
+            urlInfoStore = persistentStore.namespace('urlInfo')
+            tahoeCheckStore = persistentStore.namespace('tahoeCheck')
+        if urlInfoCache is None:
+            urlInfoCache = ExpiringCache(
+                reactor, isNegative=lambda info: not info.ok, persistent=urlInfoStore)
+        self.urlInfoCache = urlInfoCache
+        if tahoeCheckCache is None:
+            tahoeCheckCache = RevalidatingCache(reactor, persistent=tahoeCheckStore)
+            metrics.gauges['tahoe.cache'] = lambda: dict(tahoeCheckCache.counts)
+        self.tahoeCheckCache = tahoeCheckCache
+        if linkResolvers is None:
+            linkResolvers = LinkResolvers(reactor, [TwitterResolver(), GyazoResolver()])
+        self.linkResolvers = linkResolvers
+        if scheduler is None:
+            scheduler = FetchScheduler(reactor)
+        self.scheduler = scheduler
+        if parsePool is None:
+            parsePool = WorkerPool(reactor, metrics=metrics, name='theresa-parse')
+            metrics.gauges['parsePool'] = parsePool.stats
+        self.parsePool = parsePool
+        if linkShedder is None:
+            linkShedder = LinkShedder(reactor, metrics=metrics)
+            metrics.gauges['linkShedder'] = linkShedder.stats
+        self.linkShedder = linkShedder
+
+    def buildProtocol(self, addr):
+        p = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+        if self.nickname is not None:
+            p.nickname = self.nickname
+        if self.channels is not None:
+            p.channels = tuple(self.channels)
+        return p
+
+class Network(object):
+    """One IRC network for a `TheresaSupervisor` to connect to.
+
+    With `useSSL`, the server's certificate is verified for `host`.
+    `protocol`, if given, is the `TheresaProtocol` subclass to use for it.
+    """
+    def __init__(self, name, host, port=6667, channels=(), nickname='theresa', streamChannels=(),
+                 tahoe=None, useSSL=False, protocol=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.channels = channels
+        self.nickname = nickname
+        self.streamChannels = streamChannels
+        self.tahoe = tahoe
+        self.useSSL = useSSL
+        self.protocol = protocol
+
+def shardFor(name, shards):
+    "Which of `shards` worker processes runs the network called `name`."
+    return (zlib.crc32(name) & 0xffffffff) % shards
+
+class TheresaSupervisor(MultiService):
+    """Run theresa on several IRC networks in one process.
+
+    The networks share one Agent, and so its connection pool, the link
+    caches, fetch limits, parsing pool and load shedding, and one twitter
+    stream on `streamResource`, fanned out to each network's streamChannels.
+    Each network has its own `Metrics`, on top of the shared ones from
+    `twitter`.
+
+    With more than one of `shards`, only the networks which `shardFor` puts
+    in shard number `shard` are run, so that processes started with the same
+    configuration split the networks between them. Each such process has its
+    own caches and stream.
+    """
+    factory = TheresaFactory
+
+    def __init__(self, agent, twitter, networks, reactor=None, streamResource='user.json',
+                 persistentStore=None, shard=0, shards=1, tahoe=None):
+        MultiService.__init__(self)
+        from twisted.application import internet
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.twitter = twitter
+        self.metrics = metrics = twitter.metrics
+        self.networks = [network for network in networks if shardFor(network.name, shards) == shard]
+
+        urlInfoStore = tahoeCheckStore = None
+        if persistentStore is not None:
+            urlInfoStore = persistentStore.namespace('urlInfo')
+            tahoeCheckStore = persistentStore.namespace('tahoeCheck')
+        self.urlInfoCache = ExpiringCache(
+            reactor, isNegative=lambda info: not info.ok, persistent=urlInfoStore)
+        self.tahoeCheckCache = RevalidatingCache(reactor, persistent=tahoeCheckStore)
+        self.linkResolvers = LinkResolvers(reactor, [TwitterResolver(), GyazoResolver()])
+        self.scheduler = FetchScheduler(reactor)
+        self.parsePool = WorkerPool(reactor, metrics=metrics, name='theresa-parse')
+        self.linkShedder = LinkShedder(reactor, metrics=metrics)
+        metrics.gauges['tahoe.cache'] = lambda: dict(self.tahoeCheckCache.counts)
+        metrics.gauges['parsePool'] = self.parsePool.stats
+        metrics.gauges['linkShedder'] = self.linkShedder.stats
+
+        self.streamer = None
+        if streamResource is not None:
+            self.streamer = twits.StreamPreserver(twitter, streamResource, messageTypes=['tweet'])
+            self.streamer.setServiceParent(self)
+
+        self.factories = {}
+        for network in self.networks:
+            factory = self.factories[network.name] = self.factory(
+                agent, twitter, tahoe=network.tahoe or tahoe, reactor=reactor,
+                urlInfoCache=self.urlInfoCache, scheduler=self.scheduler,
+                tahoeCheckCache=self.tahoeCheckCache, linkResolvers=self.linkResolvers,
+                metrics=Metrics(reactor), persistentStore=persistentStore,
+                parsePool=self.parsePool, linkShedder=self.linkShedder, name=network.name,
+                nickname=network.nickname, channels=network.channels, streamer=self.streamer,
+                streamChannels=network.streamChannels)
+            if network.protocol is not None:
+                factory.protocol = network.protocol
+            if network.useSSL:
+                from twisted.internet import ssl
+                client = internet.SSLClient(
+                    network.host, network.port, factory,
+                    ssl.optionsForClientTLS(network.host.decode('ascii')))
+            else:
+                client = internet.TCPClient(network.host, network.port, factory)
+            client.setName(network.name)
+            client.setServiceParent(self)
+
+    def snapshot(self):
+        "The shared metrics and each network's, for `StatsResource`."
+        return {
+            'shared': self.metrics.snapshot(),
+            'networks': dict(
+                (name, factory.metrics.snapshot()) for name, factory in self.factories.iteritems()),
+        }
@@ -6,19 +6,37 @@ from twisted.application.service import Service
 from twisted.protocols.policies import TimeoutMixin
 from twisted.web.http_headers import Headers
 from twisted.protocols.basic import LineOnlyReceiver
-from twisted.internet.error import TimeoutError
-from twisted.web.client import ResponseDone
+from twisted.internet.error import ConnectingCancelledError, TimeoutError
+from twisted.web.client import ResponseDone, ResponseFailed, ResponseNeverReceived
 from twisted.web.http import PotentialDataLoss
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.python import log, failure
 import oauth2
 
+import collections
+import binascii
 import urlparse
+import itertools
+import hashlib
 import theresa
+import heapq
 import urllib
+import random
+import hmac
 import json
+import time
+import os
 import re
 
+try:
+    import ujson as _fastjson
+except ImportError:
+    try:
+        import simplejson as _fastjson
+    except ImportError:
+        _fastjson = json
+loads = _fastjson.loads
+
 defaultSignature = oauth2.SignatureMethod_HMAC_SHA1()
 defaultTwitterAPI = 'https://api.twitter.com/1.1/'
 defaultStreamingAPI = 'https://userstream.twitter.com/1.1/'
@@ -26,18 +44,108 @@ defaultStreamingAPI = 'https://userstream.twitter.com/1.1/'
 class UnexpectedHTTPStatus(Exception):
     pass
 
+class TwitNotFound(Exception):
+    pass
+
+class RateLimited(Exception):
+    "A twitter endpoint's rate limit has been used up."
+    def __str__(self):
+        endpoint, resetIn = self.args
+        return 'rate limited on %s for another %ds' % (endpoint, resetIn)
+
 def trapBadStatuses(response, goodStatuses=(200,)):
     if response.code not in goodStatuses:
+        theresa.discard(response)
         raise UnexpectedHTTPStatus(response.code, response.phrase)
     return response
 
+def oauthEscape(s):
+    "Percent-encode a value the way OAuth requires."
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    elif not isinstance(s, str):
+        s = str(s)
+    return urllib.quote(s, safe='~')
+
+class OAuthSigner(object):
+    """Sign requests with HMAC-SHA1 for a single consumer and token.
+
+    The HMAC key and the parts of the header which don't change between
+    requests are computed once, up front. The last `maxNormalizedURLs`
+    normalized URLs are remembered.
+    """
+    maxNormalizedURLs = 256
+
+    def __init__(self, consumer, token, clock=time.time):
+        self.clock = clock
+        self._hmac = hmac.new(
+            '%s&%s' % (oauthEscape(consumer.secret), oauthEscape(token.secret)),
+            digestmod=hashlib.sha1)
+        self._staticParams = [
+            ('oauth_consumer_key', oauthEscape(consumer.key)),
+            ('oauth_signature_method', 'HMAC-SHA1'),
+            ('oauth_token', oauthEscape(token.key)),
+            ('oauth_version', '1.0'),
+        ]
+        self._staticHeader = 'OAuth ' + ', '.join('%s="%s"' % param for param in self._staticParams)
+        self._normalizedURLs = collections.OrderedDict()
+
+    def _normalizeURL(self, url):
+        normalized = self._normalizedURLs.pop(url, None)
+        if normalized is None:
+            parsed = urlparse.urlsplit(url)
+            netloc = parsed.netloc.lower()
+            if ((parsed.scheme == 'http' and netloc.endswith(':80'))
+                    or (parsed.scheme == 'https' and netloc.endswith(':443'))):
+                netloc = netloc.rpartition(':')[0]
+            normalized = '%s://%s%s' % (parsed.scheme.lower(), netloc, parsed.path)
+            normalized = oauthEscape(normalized)
+            if len(self._normalizedURLs) >= self.maxNormalizedURLs:
+                self._normalizedURLs.popitem(last=False)
+        self._normalizedURLs[url] = normalized
+        return normalized
+
+    def sign(self, method, url, parameters, nonce=None, timestamp=None):
+        """Sign a request.
+
+        `url` must not have a query string; `parameters` are the query
+        parameters. Returns the Authorization header value and the encoded
+        query string.
+        """
+        if nonce is None:
+            nonce = binascii.hexlify(os.urandom(16))
+        if timestamp is None:
+            timestamp = int(self.clock())
+        encoded = [(oauthEscape(k), oauthEscape(v)) for k, v in parameters.iteritems()]
+        query = '&'.join('%s=%s' % param for param in encoded)
+        encoded.extend(self._staticParams)
+        encoded.append(('oauth_nonce', nonce))
+        encoded.append(('oauth_timestamp', str(timestamp)))
+        encoded.sort()
+        base = '%s&%s&%s' % (
+            method.upper(), self._normalizeURL(url),
+            oauthEscape('&'.join('%s=%s' % param for param in encoded)))
+        mac = self._hmac.copy()
+        mac.update(base)
+        signature = binascii.b2a_base64(mac.digest())[:-1]
+        header = '%s, oauth_nonce="%s", oauth_timestamp="%s", oauth_signature="%s"' % (
+            self._staticHeader, nonce, timestamp, oauthEscape(signature))
+        return header, query
+
 class OAuthAgent(object):
-    "An Agent wrapper that adds OAuth authorization headers."
+    """An Agent wrapper that adds OAuth authorization headers.
+
+    With the default HMAC-SHA1 signature method, requests are signed by an
+    `OAuthSigner` instead of going through `oauth2.Request`.
+    """
     def __init__(self, agent, consumer, token, signatureMethod=defaultSignature):
         self.agent = agent
         self.consumer = consumer
         self.token = token
         self.signatureMethod = signatureMethod
+        self.signer = None
+        if isinstance(signatureMethod, oauth2.SignatureMethod_HMAC_SHA1):
+            self.signer = OAuthSigner(consumer, token)
 
     def request(self, method, uri, headers=None, bodyProducer=None, parameters=None, addAuthHeader=True):
         """Make a request, optionally signing it.
@@ -49,6 +157,13 @@ class OAuthAgent(object):
             headers = Headers()
         if parameters is None:
             parameters = {}
+        if addAuthHeader and self.signer is not None:
+            base = uri.partition('?')[0]
+            authorization, query = self.signer.sign(method, base, parameters)
+            headers.addRawHeader('Authorization', authorization)
+            if query:
+                base = '%s?%s' % (base, query)
+            return self.agent.request(method, base, headers, bodyProducer)
         if addAuthHeader:
             req = oauth2.Request.from_consumer_and_token(
                 self.consumer, token=self.token,
@@ -61,18 +176,77 @@ class OAuthAgent(object):
         uri = urlparse.urlunparse(parsed._replace(query=urllib.urlencode(parameters)))
         return self.agent.request(method, uri, headers, bodyProducer)
 
+# Messages on the streaming API which aren't tweets or events are objects with
+# a single key saying what they are, e.g. {"delete": {...}}.
+envelopeMessageTypes = set([
+    'delete', 'scrub_geo', 'limit', 'status_withheld', 'user_withheld',
+    'disconnect', 'warning', 'friends', 'friends_str', 'direct_message',
+    'control',
+])
+firstKeyRegexp = re.compile(r'\s*\{\s*"([a-z_]+)"')
+
+def streamMessageType(line):
+    """Figure out what kind of message a line from a stream is without decoding it.
+
+    Returns one of `envelopeMessageTypes`, 'event', 'tweet' or 'unknown'.
+    """
+    m = firstKeyRegexp.match(line)
+    if m and m.group(1) in envelopeMessageTypes:
+        return m.group(1)
+    if '"event":' in line:
+        return 'event'
+    if '"text":' in line or '"full_text":' in line:
+        return 'tweet'
+    return 'unknown'
+
 class TwitterStream(LineOnlyReceiver, TimeoutMixin):
-    "Receive a stream of JSON in twitter's weird streaming format."
-    def __init__(self, delegate, timeoutPeriod=60):
+    """Receive a stream of JSON in twitter's weird streaming format.
+
+    If `messageTypes` is given, only lines whose `streamMessageType` is in it
+    are decoded and passed to the delegate. Lines of at least `threadThreshold`
+    bytes are decoded in a thread; the delegate still sees everything in the
+    order it was received.
+    """
+    def __init__(self, delegate, timeoutPeriod=60, messageTypes=None, threadThreshold=None,
+                 dataDelegate=None):
         self.delegate = delegate
+        self.dataDelegate = dataDelegate
         self.timeoutPeriod = timeoutPeriod
+        if messageTypes is not None:
+            messageTypes = frozenset(messageTypes)
+        self.messageTypes = messageTypes
+        self.threadThreshold = threadThreshold
         self.deferred = defer.Deferred(self._cancel)
         self._done = False
+        self._paused = False
+        self._backlog = None
+        self._backlogSize = 0
 
     def connectionMade(self):
         "Start the timeout once the connection has been established."
-        self.setTimeout(self.timeoutPeriod)
         LineOnlyReceiver.connectionMade(self)
+        if self._paused:
+            self.transport.pauseProducing()
+        else:
+            self.setTimeout(self.timeoutPeriod)
+
+    def pauseProducing(self):
+        "Stop reading from the stream, without timing out, until resumed."
+        if self._paused:
+            return
+        self._paused = True
+        if self.transport is not None:
+            self.setTimeout(None)
+            self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        "Start reading from the stream again."
+        if not self._paused:
+            return
+        self._paused = False
+        if self.transport is not None and not self._done:
+            self.setTimeout(self.timeoutPeriod)
+            self.transport.resumeProducing()
 
     def _cancel(self, ign):
         "A Deferred canceler that drops the connection."
@@ -85,13 +259,41 @@ class TwitterStream(LineOnlyReceiver, TimeoutMixin):
     def dataReceived(self, data):
         "Reset the timeout and parse the received data."
         self.resetTimeout()
+        if self.dataDelegate is not None:
+            self.dataDelegate()
         LineOnlyReceiver.dataReceived(self, data)
 
     def lineReceived(self, line):
         "Ignoring empty-line keepalives, inform the delegate about new data."
         if not line:
             return
-        obj = json.loads(line)
+        if self.messageTypes is not None and streamMessageType(line) not in self.messageTypes:
+            return
+        if self._backlog is None and (
+                self.threadThreshold is None or len(line) < self.threadThreshold):
+            self._deliver(loads(line))
+            return
+        self._queueLine(line)
+
+    def _queueLine(self, line):
+        if self.threadThreshold is not None and len(line) >= self.threadThreshold:
+            decoded = threads.deferToThread(loads, line)
+        else:
+            decoded = defer.maybeDeferred(loads, line)
+        if self._backlog is None:
+            self._backlog = defer.succeed(None)
+        self._backlogSize += 1
+        self._backlog.addCallback(lambda ign: decoded)
+        self._backlog.addCallback(self._deliver)
+        self._backlog.addErrback(log.err, 'error decoding stream data')
+        self._backlog.addBoth(self._lineDone)
+
+    def _lineDone(self, ign):
+        self._backlogSize -= 1
+        if not self._backlogSize:
+            self._backlog = None
+
+    def _deliver(self, obj):
         try:
             self.delegate(obj)
         except:
@@ -116,19 +318,241 @@ class TwitterStream(LineOnlyReceiver, TimeoutMixin):
         else:
             self.deferred.errback(reason)
 
+class RateLimiter(object):
+    """Keep track of twitter's per-endpoint rate limits.
+
+    The limits are learned from the x-rate-limit-* headers of responses.
+    Requests are run in order of priority, at most `maxConcurrent` at a time,
+    and fail with `RateLimited` instead of being made once an endpoint's
+    budget has been used up. Cancelling a request drops it from the queue, or
+    cancels it and frees its slot if it's running.
+    """
+    def __init__(self, reactor, maxConcurrent=4, defaultBackoff=60):
+        self.reactor = reactor
+        self.maxConcurrent = maxConcurrent
+        self.defaultBackoff = defaultBackoff
+        self._limits = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._running = 0
+        self._fetching = {}
+        self.rejected = collections.Counter()
+
+    def update(self, endpoint, response):
+        "Learn about `endpoint`'s rate limit from `response`."
+        remaining = response.headers.getRawHeaders('x-rate-limit-remaining')
+        reset = response.headers.getRawHeaders('x-rate-limit-reset')
+        if remaining and reset:
+            try:
+                self._limits[endpoint] = int(remaining[0]), int(reset[0])
+            except ValueError:
+                pass
+        elif response.code == 429:
+            self._limits[endpoint] = 0, self.reactor.seconds() + self.defaultBackoff
+
+    def resetIn(self, endpoint):
+        """How long until `endpoint` can be used again.
+
+        This is 0 if there's budget left or nothing is known about it.
+        """
+        state = self._limits.get(endpoint)
+        if state is None:
+            return 0
+        remaining, reset = state
+        now = self.reactor.seconds()
+        if reset <= now:
+            del self._limits[endpoint]
+            return 0
+        if remaining > 0:
+            return 0
+        return reset - now
+
+    def _spend(self, endpoint):
+        state = self._limits.get(endpoint)
+        if state is not None:
+            remaining, reset = state
+            self._limits[endpoint] = remaining - 1, reset
+
+    def submit(self, endpoint, priority, fetch, *args, **kwargs):
+        """Call `fetch` with the remaining arguments when it's `endpoint`'s turn.
+
+        Lower values of `priority` go first. Returns a `Deferred` firing with
+        the result of `fetch`.
+        """
+        resetIn = self.resetIn(endpoint)
+        if resetIn:
+            self.rejected[endpoint] += 1
+            return defer.fail(RateLimited(endpoint, resetIn))
+        d = defer.Deferred(self._cancel)
+        heapq.heappush(self._queue, (priority, next(self._counter), endpoint, d, fetch, args, kwargs))
+        self._pump()
+        return d
+
+    def _pump(self):
+        while self._running < self.maxConcurrent and self._queue:
+            _, _, endpoint, d, fetch, args, kwargs = heapq.heappop(self._queue)
+            resetIn = self.resetIn(endpoint)
+            if resetIn:
+                self.rejected[endpoint] += 1
+                d.errback(RateLimited(endpoint, resetIn))
+                continue
+            self._spend(endpoint)
+            self._running += 1
+            fetched = self._fetching[d] = defer.maybeDeferred(fetch, *args, **kwargs)
+            fetched.addBoth(self._done, d)
+            fetched.chainDeferred(d)
+
+    def _done(self, result, d):
+        del self._fetching[d]
+        self._running -= 1
+        self._pump()
+        return result
+
+    def _cancel(self, d):
+        fetched = self._fetching.get(d)
+        if fetched is not None:
+            fetched.cancel()
+            return
+        self._queue = [entry for entry in self._queue if entry[3] is not d]
+        heapq.heapify(self._queue)
+
+    def stats(self):
+        now = self.reactor.seconds()
+        return {
+            'queued': len(self._queue),
+            'running': self._running,
+            'rejected': dict(self.rejected),
+            'limits': dict(
+                (endpoint, {'remaining': remaining, 'resetIn': max(0, reset - now)})
+                for endpoint, (remaining, reset) in self._limits.iteritems()),
+        }
+
+endpointIDRegexp = re.compile(r'/\d+(?=[./]|$)')
+
+def endpointFor(resource):
+    "The rate-limited endpoint a resource belongs to, e.g. 'statuses/destroy/:id'."
+    return endpointIDRegexp.sub('/:id', resource.rpartition('.json')[0] or resource)
+
+class TwitBatcher(object):
+    """Resolve tweet IDs in bulk.
+
+    IDs requested within `delay` seconds of each other are looked up with a
+    single call to statuses/lookup.json, which accepts up to 100 IDs.
+    """
+    def __init__(self, twitter, reactor, delay=0.1, maxBatch=100):
+        self.twitter = twitter
+        self.reactor = reactor
+        self.delay = delay
+        self.maxBatch = maxBatch
+        self._pending = {}
+        self._flushCall = None
+
+    def lookup(self, id):
+        "Return a `Deferred` firing with the tweet with the ID `id`."
+        d = defer.Deferred()
+        self._pending.setdefault(str(id), []).append(d)
+        if len(self._pending) >= self.maxBatch:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self.reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        "Look up every pending ID now."
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        d = self.twitter.request(
+            'statuses/lookup.json', 'POST', priority=theresa.PRIORITY_LINK,
+            id=','.join(pending), include_entities='true')
+        # _lookupFailed also catches errors from _gotTwits, e.g. on a response
+        # of an unexpected shape.
+        d.addCallback(self._gotTwits, pending)
+        d.addErrback(self._lookupFailed, pending)
+
+    def _gotTwits(self, twits, pending):
+        for twit in twits:
+            for d in pending.pop(twit['id_str'], ()):
+                d.callback(twit)
+        for id, ds in pending.iteritems():
+            for d in ds:
+                d.errback(TwitNotFound(id))
+
+    def _lookupFailed(self, f, pending):
+        for ds in pending.itervalues():
+            for d in ds:
+                if not d.called:
+                    d.errback(f)
+
 class Twitter(object):
     "Close to the most minimal twitter interface ever."
-    def __init__(self, agent, twitterAPI=defaultTwitterAPI, streamingAPI=defaultStreamingAPI):
+    maxResponseSize = 4194304
+    requestTimeout = 30
+
+    def __init__(self, agent, twitterAPI=defaultTwitterAPI, streamingAPI=defaultStreamingAPI,
+                 reactor=None, twitCache=None, rateLimiter=None, responseCache=None,
+                 renderCache=None, metrics=None, persistentStore=None):
         self.agent = agent
         self.twitterAPI = twitterAPI
         self.streamingAPI = streamingAPI
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if twitCache is None:
+            twitCache = theresa.ExpiringCache(
+                reactor, maxSize=4096, ttl=900, negativeTTL=60,
+                persistent=persistentStore and persistentStore.namespace('twits'))
+        self.twitCache = twitCache
+        self.batcher = TwitBatcher(self, reactor)
+        if rateLimiter is None:
+            rateLimiter = RateLimiter(reactor)
+        self.rateLimiter = rateLimiter
+        if responseCache is None:
+            responseCache = theresa.ExpiringCache(reactor, maxSize=256, ttl=3600)
+        self.responseCache = responseCache
+        if renderCache is None:
+            renderCache = theresa.ExpiringCache(reactor, maxSize=4096, ttl=86400)
+        self.renderCache = renderCache
+        if metrics is None:
+            metrics = theresa.Metrics(reactor)
+        self.metrics = metrics
+        metrics.gauges['twitter.rateLimiter'] = rateLimiter.stats
+
+    def _trackRateLimit(self, response, resource):
+        self.rateLimiter.update(endpointFor(resource), response)
+        return response
 
     def _makeRequest(self, whichAPI, method, resource, parameters):
         d = self.agent.request(method, urlparse.urljoin(whichAPI, resource), parameters=parameters)
+        d.addCallback(self._trackRateLimit, resource)
         d.addCallback(trapBadStatuses)
         return d
 
-    def request(self, resource, method='GET', **parameters):
+    def _request(self, resource, method, parameters):
+        d = self._makeRequest(self.twitterAPI, method, resource, parameters)
+        d.addCallback(theresa.receive, theresa.JSONReceiver(self.maxResponseSize, loads))
+        d.addTimeout(self.requestTimeout, self.reactor)
+        return self.metrics.timed('twitter.' + endpointFor(resource), d)
+
+    def _cacheResponse(self, result, key):
+        self.responseCache.set(key, result)
+        return result
+
+    def _serveCachedResponse(self, f, key):
+        f.trap(RateLimited)
+        self.metrics.count('twitter.rateLimited')
+        try:
+            response = self.responseCache.get(key)
+        except KeyError:
+            return f
+        self.metrics.count('twitter.servedStale')
+        return response
+
+    def request(self, resource, method='GET', priority=None, **parameters):
         """Make a GET request from the twitter 1.1 API.
 
         `resource` is the part of the resource URL not including the API URL,
@@ -136,77 +560,369 @@ class Twitter(object):
         this should always end in '.json'. Any parameters passed in as keyword
         arguments will be added to the URL as the query string. The `Deferred`
         returned will fire with the decoded JSON.
+
+        Requests are made through the `RateLimiter` with the given `priority`,
+        which defaults to `theresa.PRIORITY_COMMAND`. If the endpoint's rate
+        limit has been used up, a GET is answered with the last response to the
+        same request if there is one, and otherwise fails with `RateLimited`.
         """
-        d = self._makeRequest(self.twitterAPI, method, resource, parameters)
-        d.addCallback(theresa.receive, theresa.StringReceiver())
-        d.addCallback(json.loads)
+        if priority is None:
+            priority = theresa.PRIORITY_COMMAND
+        d = self.rateLimiter.submit(
+            endpointFor(resource), priority, self._request, resource, method, parameters)
+        if method == 'GET':
+            key = resource, tuple(sorted(parameters.iteritems()))
+            d.addCallback(self._cacheResponse, key)
+            d.addErrback(self._serveCachedResponse, key)
         return d
 
-    def stream(self, resource, delegate, **parameters):
+    def renderTwitText(self, twit):
+        "Like the module-level `renderTwitText`, but memoized by tweet ID."
+        id = twit.get('id_str')
+        if id is None:
+            return renderTwitText(twit)
+        try:
+            return self.renderCache.get(id)
+        except KeyError:
+            rendered = renderTwitText(twit)
+            self.renderCache.set(id, rendered)
+            return rendered
+
+    def lookupTwit(self, id):
+        """Fetch a single tweet by ID.
+
+        Lookups are batched and the tweets are memoized by ID, so this is
+        preferable to requesting statuses/show.json directly.
+        """
+        id = str(id)
+        return self.twitCache.lookup(id, self.batcher.lookup, id)
+
+    def stream(self, resource, delegate, messageTypes=None, threadThreshold=None,
+               dataDelegate=None, **parameters):
         """Receive from the twitter 1.1 streaming API.
 
         `resource` and keyword arguments are treated the same as the in
         `request`, and `delegate` will be called with each JSON object which is
-        received from the stream. The `Deferred` returned will fire when the
-        stream has ended.
+        received from the stream. `messageTypes`, `threadThreshold` and
+        `dataDelegate` are passed along to `TwitterStream`. The `Deferred`
+        returned will fire when the stream has ended.
+        """
+        return self.streamWith(resource, TwitterStream(
+            delegate, messageTypes=messageTypes, threadThreshold=threadThreshold,
+            dataDelegate=dataDelegate), **parameters)
+
+    def streamWith(self, resource, protocol, **parameters):
+        """Like `stream`, but read the stream with an existing `TwitterStream`.
+
+        This is for callers which need to get at the protocol, e.g. to pause it.
         """
         d = self._makeRequest(self.streamingAPI, 'GET', resource, parameters)
-        d.addCallback(theresa.receive, TwitterStream(delegate))
+        d.addCallback(theresa.receive, protocol)
         return d
 
+class ReconnectPolicy(object):
+    """Decide how long to wait before reconnecting a stream.
+
+    The delays follow twitter's advice: back off exponentially, starting small
+    for network errors, larger for HTTP errors and larger still when rate
+    limited (420 or 429). Each delay is stretched by up to `jitter` of itself.
+    """
+    rateLimitStatuses = frozenset([420, 429])
+
+    def __init__(self, network=(0.25, 16), http=(5, 320), rateLimited=(60, 960),
+                 jitter=0.25, random=random.random):
+        self.delays = {'network': network, 'http': http, 'rateLimited': rateLimited}
+        self.jitter = jitter
+        self.random = random
+        self.failures = collections.Counter()
+        self._attempts = collections.Counter()
+
+    def classify(self, reason):
+        "Decide what kind of failure `reason` represents."
+        if isinstance(reason, failure.Failure) and reason.check(UnexpectedHTTPStatus):
+            if reason.value.args[0] in self.rateLimitStatuses:
+                return 'rateLimited'
+            return 'http'
+        return 'network'
+
+    def delay(self, reason):
+        "How long to wait after a stream ended because of `reason`."
+        kind = self.classify(reason)
+        self.failures[kind] += 1
+        initial, maximum = self.delays[kind]
+        delay = min(maximum, initial * 2 ** self._attempts[kind])
+        self._attempts[kind] += 1
+        return delay * (1 + self.jitter * self.random())
+
+    def reset(self):
+        "The stream is healthy again, so start backing off from scratch."
+        self._attempts.clear()
+
+DROP_OLDEST, COALESCE, PAUSE = 'drop-oldest', 'coalesce', 'pause'
+
+def twitAuthorKey(data):
+    "Coalesce stream data by who wrote it."
+    return data.get('user', {}).get('id_str')
+
+class DelegateQueue(object):
+    """Deliver stream data to a delegate through a bounded queue.
+
+    Data is delivered from the reactor rather than from the stream's
+    `dataReceived`, at most `batchSize` items per reactor iteration. If the
+    delegate returns a `Deferred`, nothing more is delivered until it fires.
+
+    When more than `maxSize` items are waiting, `overflow` decides what
+    happens: DROP_OLDEST drops the oldest item; COALESCE replaces a waiting
+    item with the same `coalesceKey`, or drops the oldest one if there isn't
+    one; PAUSE calls `onFull`, and later `onDrained` once the queue is down
+    to half of `maxSize`.
+    """
+    def __init__(self, delegate, reactor, maxSize=100, overflow=DROP_OLDEST,
+                 coalesceKey=twitAuthorKey, batchSize=10, onFull=None, onDrained=None):
+        self.delegate = delegate
+        self.reactor = reactor
+        self.maxSize = maxSize
+        self.overflow = overflow
+        self.coalesceKey = coalesceKey
+        self.batchSize = batchSize
+        self.onFull = onFull
+        self.onDrained = onDrained
+        self._queue = collections.deque()
+        self._drainCall = None
+        self._delivering = False
+        self.full = False
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lastLag = 0
+        self.maxLag = 0
+
+    def put(self, data):
+        "Queue `data` for the delegate."
+        item = self.reactor.seconds(), data
+        if len(self._queue) >= self.maxSize:
+            if self.overflow == COALESCE and self._coalesce(item):
+                return
+            elif self.overflow == PAUSE:
+                if not self.full:
+                    self.full = True
+                    if self.onFull is not None:
+                        self.onFull(self)
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+        self._queue.append(item)
+        self._scheduleDrain()
+
+    def _coalesce(self, item):
+        key = self.coalesceKey(item[1])
+        if key is not None:
+            for e, (enqueued, queued) in enumerate(self._queue):
+                if self.coalesceKey(queued) == key:
+                    # Keep the original timestamp so that lag isn't hidden.
+                    self._queue[e] = enqueued, item[1]
+                    self.coalesced += 1
+                    return True
+        self._queue.popleft()
+        self.dropped += 1
+        return False
+
+    def _scheduleDrain(self):
+        if self._drainCall is None and not self._delivering and self._queue:
+            self._drainCall = self.reactor.callLater(0, self._drain)
+
+    def _drain(self):
+        self._drainCall = None
+        for _ in xrange(self.batchSize):
+            if not self._queue:
+                break
+            enqueued, data = self._queue.popleft()
+            self.lastLag = self.reactor.seconds() - enqueued
+            self.maxLag = max(self.maxLag, self.lastLag)
+            self.delivered += 1
+            d = defer.maybeDeferred(self.delegate, data)
+            d.addErrback(log.err, 'error calling delegate %r' % (self.delegate,))
+            if not d.called:
+                self._delivering = True
+                d.addBoth(self._delivered)
+                break
+        if self.full and len(self._queue) <= self.maxSize // 2:
+            self.full = False
+            if self.onDrained is not None:
+                self.onDrained(self)
+        self._scheduleDrain()
+
+    def _delivered(self, ign):
+        self._delivering = False
+        self._scheduleDrain()
+
+    def stop(self):
+        "Stop delivering and forget about anything waiting."
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+            self._drainCall = None
+        self._queue.clear()
+        if self.full:
+            self.full = False
+            if self.onDrained is not None:
+                self.onDrained(self)
+
+    def stats(self):
+        oldest = self.reactor.seconds() - self._queue[0][0] if self._queue else 0
+        return {
+            'depth': len(self._queue),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'lastLag': self.lastLag,
+            'maxLag': self.maxLag,
+            'oldestWait': oldest,
+            'full': self.full,
+        }
+
 class StreamPreserver(Service):
     "Keep a stream connected as a service."
-    def __init__(self, twitter, resource, **parameters):
+    def __init__(self, twitter, resource, messageTypes=None, threadThreshold=None,
+                 reconnectPolicy=None, **parameters):
         self.twitter = twitter
+        self.reactor = twitter.reactor
         self.resource = resource
+        self.messageTypes = messageTypes
+        self.threadThreshold = threadThreshold
+        if reconnectPolicy is None:
+            reconnectPolicy = ReconnectPolicy()
+        self.reconnectPolicy = reconnectPolicy
         self.parameters = parameters
+        self._stream = None
         self._streamDone = None
-        self._delegates = set()
+        self._reconnectCall = None
+        self._delegates = {}
+        self._pausedBy = set()
+        self.reconnects = 0
+        self.connectedAt = None
+        self.lastDataAt = None
 
     def __repr__(self):
         return '<StreamPreserver %#x for %r/%r>' % (id(self), self.resource, self.parameters)
 
-    def _connectStream(self, r):
-        if isinstance(r, failure.Failure) and r.check(defer.CancelledError):
-            log.msg('not reconnecting twitter stream %r' % self)
+    def _connectStream(self):
+        self._reconnectCall = None
+        log.msg('connecting twitter stream %r' % self)
+        self._stream = TwitterStream(
+            self._streamDelegate, messageTypes=self.messageTypes,
+            threadThreshold=self.threadThreshold, dataDelegate=self._gotData)
+        if self._pausedBy:
+            self._stream.pauseProducing()
+        d = self._streamDone = self.twitter.streamWith(self.resource, self._stream, **self.parameters)
+        d.addBoth(self._streamEnded)
+
+    def _streamEnded(self, r):
+        self._stream = None
+        self._streamDone = None
+        self.connectedAt = None
+        if isinstance(r, failure.Failure):
+            if wasCancelled(r):
+                log.msg('not reconnecting twitter stream %r' % self)
+                return
+            log.err(r, 'error reading from twitter stream %r' % self)
+        if not self.running:
             return
-        log.msg('reconnecting twitter stream %r' % self)
-        d = self._streamDone = self.twitter.stream(self.resource, self._streamDelegate, **self.parameters)
-        d.addBoth(self._connectStream)
-        d.addErrback(log.err, 'error reading from twitter stream %r' % self)
-        return r
+        delay = self.reconnectPolicy.delay(r)
+        log.msg('reconnecting twitter stream %r in %.1fs' % (self, delay))
+        self.reconnects += 1
+        self._reconnectCall = self.reactor.callLater(delay, self._connectStream)
+
+    def _gotData(self):
+        now = self.reactor.seconds()
+        if self.connectedAt is None:
+            self.connectedAt = now
+            self.reconnectPolicy.reset()
+        self.lastDataAt = now
 
     def _streamDelegate(self, data):
-        for delegate in self._delegates:
-            try:
-                delegate(data)
-            except Exception:
-                log.err('error calling delegate %r' % (delegate,))
+        for queue in self._delegates.itervalues():
+            queue.put(data)
+
+    def _queueFull(self, queue):
+        if not self._pausedBy and self._stream is not None:
+            self._stream.pauseProducing()
+        self._pausedBy.add(queue)
+
+    def _queueDrained(self, queue):
+        self._pausedBy.discard(queue)
+        if not self._pausedBy and self._stream is not None:
+            self._stream.resumeProducing()
+
+    def addDelegate(self, delegate, maxSize=100, overflow=DROP_OLDEST, coalesceKey=twitAuthorKey):
+        """Add a delegate to receive stream data.
 
-    def addDelegate(self, delegate):
-        "Add a delegate to receive stream data."
-        self._delegates.add(delegate)
+        Each delegate gets its own `DelegateQueue`; the arguments other than
+        `delegate` are passed along to it.
+        """
+        if delegate in self._delegates:
+            return
+        self._delegates[delegate] = DelegateQueue(
+            delegate, self.reactor, maxSize=maxSize, overflow=overflow, coalesceKey=coalesceKey,
+            onFull=self._queueFull, onDrained=self._queueDrained)
 
     def removeDelegate(self, delegate):
         "Remove a previously-added stream data delegate."
-        self._delegates.discard(delegate)
+        queue = self._delegates.pop(delegate, None)
+        if queue is not None:
+            queue.stop()
+
+    def stats(self):
+        "Counters describing the health of the stream."
+        now = self.reactor.seconds()
+        return {
+            'connected': self.connectedAt is not None,
+            'reconnects': self.reconnects,
+            'failures': dict(self.reconnectPolicy.failures),
+            'uptime': now - self.connectedAt if self.connectedAt is not None else 0,
+            'sinceLastData': now - self.lastDataAt if self.lastDataAt is not None else None,
+            'paused': bool(self._pausedBy),
+            'delegates': dict(
+                (repr(delegate), queue.stats()) for delegate, queue in self._delegates.iteritems()),
+        }
 
     def startService(self):
         "Start reading from the stream."
-        if not self.running:
-            self._connectStream(None)
+        if self.running:
+            return
         Service.startService(self)
+        self.twitter.metrics.gauges['stream.' + self.resource] = self.stats
+        self._connectStream()
 
     def stopService(self):
         "Stop reading from the stream."
         ret = None
-        if self.running and self._streamDone is not None:
-            self._streamDone.cancel()
+        wasRunning = self.running
+        # Stop first, so that _streamEnded doesn't reconnect after the cancel.
+        Service.stopService(self)
+        if self._reconnectCall is not None:
+            self._reconnectCall.cancel()
+            self._reconnectCall = None
+        if wasRunning and self._streamDone is not None:
             ret = self._streamDone
-        Service.startService(self)
+            ret.cancel()
+        self.twitter.metrics.gauges.pop('stream.' + self.resource, None)
         return ret
 
 
+def wasCancelled(f):
+    """Whether a failure is from a cancelled request.
+
+    Cancelling a request before or while its response arrives fails with a
+    `ResponseNeverReceived` or `ResponseFailed` wrapping the `CancelledError`,
+    and cancelling it while connecting fails with `ConnectingCancelledError`.
+    """
+    if f.check(defer.CancelledError, ConnectingCancelledError):
+        return True
+    if f.check(ResponseNeverReceived, ResponseFailed):
+        return any(reason.check(defer.CancelledError) for reason in f.value.reasons)
+    return False
+
+
 entityReplacements = [
     ('media', 'media_url_https'),
     ('urls', 'expanded_url'),
@@ -220,18 +936,55 @@ dumbCrapReplacements = {
 }
 dumbCrapRegexp = re.compile('|'.join(re.escape(s) for s in dumbCrapReplacements))
 
-def extractRealTwitText(twit):
-    "Oh my god why is this necessary."
+def _escapeControls(text):
+    return unicode(text).translate(theresa.controlEquivalents)
+
+def _unescapeAndEscapeControls(text):
+    if u'&' in text:
+        text = dumbCrapRegexp.sub(lambda m: dumbCrapReplacements[m.group()], text)
+    return text.translate(theresa.controlEquivalents)
+
+def _renderText(text, entities, pieces):
+    replacements = sorted(set(
+        (tuple(entity['indices']), entity[replacement])
+        for entityType, replacement in entityReplacements
+        for entity in entities.get(entityType, ())))
+    position = 0
+    for (l, r), replacement in replacements:
+        if l < position:
+            continue
+        pieces.append(_unescapeAndEscapeControls(text[position:l]))
+        pieces.append(_escapeControls(replacement))
+        position = r
+    pieces.append(_unescapeAndEscapeControls(text[position:]))
+
+def _renderTwit(twit, pieces):
     if 'retweeted_status' in twit:
         rt = twit['retweeted_status']
-        return u'RT @%s: %s' % (rt['user']['screen_name'], extractRealTwitText(rt))
-    replacements = sorted(
-        (entity['indices'], entity[replacement])
-        for entityType, replacement in entityReplacements
-        if entityType in twit['entities']
-        for entity in twit['entities'][entityType])
-    mutableText = list(twit['text'])
-    for (l, r), replacement in reversed(replacements):
-        mutableText[l:r] = replacement
-    text = u''.join(mutableText)
-    return dumbCrapRegexp.sub(lambda m: dumbCrapReplacements[m.group()], text)
+        pieces.append(u'RT @%s: ' % (_escapeControls(rt['user']['screen_name']),))
+        _renderTwit(rt, pieces)
+        return
+    if 'extended_tweet' in twit:
+        extended = twit['extended_tweet']
+        text, entities = extended['full_text'], extended.get('entities', {})
+    else:
+        text = twit['full_text'] if 'full_text' in twit else twit['text']
+        entities = twit.get('entities', {})
+    _renderText(unicode(text), entities, pieces)
+    quoted = twit.get('quoted_status')
+    if quoted is not None:
+        pieces.append(u' (quoting @%s: ' % (_escapeControls(quoted['user']['screen_name']),))
+        _renderTwit(quoted, pieces)
+        pieces.append(u')')
+
+def renderTwitText(twit):
+    """Render the text of a tweet for IRC, as UTF-8.
+
+    In one pass over the text, URL and media entities are replaced with what
+    they point to, HTML entities are unescaped and control characters are
+    replaced with their Unicode pictures. Retweets, extended tweets and quoted
+    tweets are rendered in full.
+    """
+    pieces = []
+    _renderTwit(twit, pieces)
+    return u''.join(pieces).encode('utf-8')